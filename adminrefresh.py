@@ -0,0 +1,90 @@
+import threading
+import time
+import traceback
+
+
+class AdminRefresher(object):
+    """Keeps the cached admin list of every monitored chat warm.
+
+    A background thread re-fetches the admins of each chat every
+    `interval` seconds, well inside the cache timeout, so message handlers
+    never wait on `get_chat_administrators`.  Member service messages
+    are applied to the cached list right away and trigger an early refresh
+    of that chat.
+    """
+
+    def __init__(self, cache, fetch, chat_ids, interval=10*60):
+        """
+        :param cache: MWT cache of admin ID lists, keyed by chat_id
+        :param fetch: callable(chat_id) returning the chat's admin IDs
+        :param chat_ids: chat IDs, or a callable returning the current ones
+        """
+        self.cache = cache
+        self.fetch = fetch
+        self.chat_ids = chat_ids if callable(chat_ids) else list(chat_ids)
+        self.interval = interval
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='admin-refresher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def request_refresh(self, chat_id):
+        with self._lock:
+            self._pending.add(chat_id)
+        self._wakeup.set()
+
+    def observe(self, message):
+        """ Apply admin changes implied by a member service message """
+        if message.left_chat_member is not None:
+            user_id = message.left_chat_member.id
+            admin_ids = self.cache.get(message.chat_id)
+            if admin_ids is not None and user_id in admin_ids:
+                self.cache.set(
+                    message.chat_id,
+                    [i for i in admin_ids if i != user_id])
+            self.request_refresh(message.chat_id)
+        elif message.new_chat_members:
+            self.request_refresh(message.chat_id)
+
+    def refresh(self, chat_id):
+        try:
+            self.cache.set(chat_id, self.fetch(chat_id))
+        except Exception as e:
+            print("Error refreshing admins of chat {}: {}".format(chat_id, e))
+            print(traceback.format_exc())
+
+    def monitored(self):
+        return list(self.chat_ids() if callable(self.chat_ids) else self.chat_ids)
+
+    def _run(self):
+        chat_ids = self.monitored()
+        next_full = time.time() + self.interval
+        while not self._stopped.is_set():
+            for chat_id in chat_ids:
+                self.refresh(chat_id)
+
+            self._wakeup.wait(max(0, next_full - time.time()))
+            self._wakeup.clear()
+            with self._lock:
+                pending, self._pending = self._pending, set()
+
+            if time.time() >= next_full:
+                chat_ids = self.monitored()
+                next_full = time.time() + self.interval
+            else:
+                # Woken early for specific chats
+                chat_ids = list(pending)
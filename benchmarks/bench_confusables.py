@@ -0,0 +1,74 @@
+"""Cost of confusables.normalize compared to plain unidecode
+
+Run from the repo root:
+
+    python benchmarks/bench_confusables.py
+
+"""
+
+import os
+import random
+import string
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import unidecode
+
+import confusables
+
+random.seed(1)
+
+OBFUSCATED = [
+    'frее аirdrор',
+    'ｆｒｅｅ ｔｏｋｅｎｓ',
+    '𝐜𝐥𝐚𝐢𝐦 𝐧𝐨𝐰',
+    'ѕеnd 1 ЕТН',
+    'bon​us',
+]
+FOREIGN = ['Привет всем', 'Καλημέρα σας', 'más información', 'こんにちは']
+
+
+def word(n):
+    return ''.join(random.choice(string.ascii_lowercase) for _ in range(n))
+
+
+def messages(count):
+    msgs = []
+    for i in range(count):
+        words = [word(random.randint(2, 9)) for _ in range(random.randint(3, 30))]
+        if i % 10 == 0:
+            words.append(random.choice(OBFUSCATED))
+        elif i % 10 == 1:
+            words.append(random.choice(FOREIGN))
+        msgs.append(' '.join(words))
+    return msgs
+
+
+def main():
+    msgs = messages(2000)
+    names = [' '.join(m.split()[:2]) for m in msgs]
+
+    def plain():
+        for m in msgs:
+            unidecode.unidecode(m)
+
+    def normalize():
+        confusables._normalize_short.cache_clear()
+        for m in msgs:
+            confusables.normalize(m)
+
+    def names_memoized():
+        for n in names:
+            confusables.normalize(n)
+
+    for name, fn in (('unidecode', plain), ('normalize', normalize),
+                     ('names', names_memoized)):
+        runs = timeit.repeat(fn, number=5, repeat=3)
+        per_msg = min(runs) / (5 * len(msgs))
+        print('{:<10} {:8.2f} us/message'.format(name, per_msg * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Compare the combined RuleMatcher against one regex search per class
+
+Run from the repo root:
+
+    python benchmarks/bench_matcher.py
+
+"""
+
+import os
+import random
+import re
+import string
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from matcher import DEFAULT_FLAGS, RuleMatcher
+
+random.seed(1)
+
+
+def word(n):
+    return ''.join(random.choice(string.ascii_lowercase) for _ in range(n))
+
+
+def patterns(count, comment):
+    """ VERBOSE pattern list in the style of env_sample.sh """
+    lines = [
+        '# ETH',
+        '[0-9a-fA-F]{40,40}',
+        '# BTC',
+        '|[0-9a-zA-Z]{34,34}',
+    ]
+    for i in range(count):
+        lines.append('# {} {}'.format(comment, i))
+        lines.append('|{}\\s*{}'.format(word(random.randint(4, 9)), word(random.randint(3, 7))))
+    return '\n'.join(lines)
+
+
+def messages(count):
+    msgs = []
+    for i in range(count):
+        words = [word(random.randint(2, 9)) for _ in range(random.randint(3, 30))]
+        if i % 50 == 0:
+            words.append('F8C8405e85Cfe42551DEfeB2a4548A33bb3DF840')
+        msgs.append(' '.join(words))
+    return msgs
+
+
+def main():
+    ban = patterns(300, 'ban')
+    hide = patterns(300, 'hide')
+    msgs = messages(2000)
+
+    ban_re = re.compile(ban, DEFAULT_FLAGS)
+    hide_re = re.compile(hide, DEFAULT_FLAGS)
+    matcher = RuleMatcher([('ban', ban), ('hide', hide)])
+
+    def separate():
+        for m in msgs:
+            if ban_re.search(m):
+                pass
+            elif hide_re.search(m):
+                pass
+
+    def combined():
+        for m in msgs:
+            matcher.match(m)
+
+    # Both approaches must agree before timing them
+    for m in msgs:
+        expected = 'ban' if ban_re.search(m) else 'hide' if hide_re.search(m) else None
+        assert matcher.match(m) == expected, m
+
+    for name, fn in (('separate', separate), ('combined', combined)):
+        runs = timeit.repeat(fn, number=5, repeat=3)
+        per_msg = min(runs) / (5 * len(msgs))
+        print('{:<10} {:8.2f} us/message'.format(name, per_msg * 1e6))
+
+
+if __name__ == '__main__':
+    main()
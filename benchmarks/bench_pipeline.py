@@ -0,0 +1,440 @@
+"""Replay update streams through the bot's logger and command handler
+
+Runs TelegramMonitorBot.prefilter, logger and handle_command in process,
+the way the dispatcher would, against a stub Bot API, the stub translator,
+canned CoinMarketCap quotes and a local database.  For each scenario it prints
+updates/sec, p50/p99 latency per update and per stage (from the metrics
+module), the time needed to drain the write and enrichment queues, and
+the memory retained and the peak traced memory per update (from a second
+pass, so tracing doesn't skew the timings).
+
+    python benchmarks/bench_pipeline.py                      # every scenario
+    python benchmarks/bench_pipeline.py raid price_storm     # some of them
+    python benchmarks/bench_pipeline.py --replay updates.jsonl
+
+Scenarios: `normal` chat, a spam `raid`, a `new_users` flood and a
+`price_storm` of /price commands.  `--replay` takes recorded updates, one
+Bot API JSON object per line, as for fake_telegram.py.
+
+The database is a temporary SQLite file unless TELEGRAM_BOT_POSTGRES_URL
+points at a local Postgres; missing tables are created.  Use `--save` to
+store the results as JSON and `--compare` to exit with an error when
+throughput dropped more than `--tolerance` against saved results.
+
+"""
+
+import argparse
+import gc
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+ETH_ADDRESS = 'F8C8405e85Cfe42551DEfeB2a4548A33bb3DF840'
+CHAT_IDS = [-1001, -1002, -1003, -1004]
+ADMIN_ID = 1
+
+# Settings for the bot under test, unless set in the environment
+BENCH_ENV = {
+    'TELEGRAM_BOT_TOKEN': '123456:bench',
+    'CHAT_IDS': ','.join(map(str, CHAT_IDS)),
+    'MESSAGE_BAN_PATTERNS': '[0-9a-fA-F]{40,40}\n|[0-9a-zA-Z]{34,34}',
+    'MESSAGE_HIDE_PATTERNS': 'free\\s*airdrop\n|t\\.me/joinchat',
+    'NAME_BAN_PATTERNS': 'admin$',
+    'CMC_API_KEY': 'bench',
+    'TRANSLATOR': 'stub',
+    'ENRICH_BACKEND': 'local',
+}
+
+NORMAL_TEXTS = [
+    'gm everyone',
+    'When is the next release?',
+    'The price looks good today, thanks for the update guys',
+    'Has anyone tried the new marketplace?',
+    'I think the team is doing a great job',
+    'Where can I buy the token?',
+    'lol',
+    'Is the staking program still open?',
+    'Hola a todos, cuando sale la nueva version?',
+    'Bonjour, je ne trouve pas le lien du whitepaper',
+    'Привет всем, есть новости?',
+]
+SPAM_TEXTS = [
+    'Send 1 ETH to {} and get 10 back'.format(ETH_ADDRESS),
+    'FREE AIRDROP today only, claim now',
+    'frее аirdrор for everyone',
+    'Join us t.me/joinchat/AAAAAEk',
+]
+PRICE_COMMANDS = ['/price', '/price all', '/price usdt', '/price dai', '/price xyz']
+
+
+class StubBot(object):
+    """ Answers the Bot API calls made by the bot without any network """
+
+    def __init__(self):
+        self.calls = {}
+        self._message_ids = itertools.count(10 ** 6)
+
+    def _call(self, method):
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+    def get_chat_administrators(self, chat_id):
+        self._call('get_chat_administrators')
+        return [SimpleNamespace(user=SimpleNamespace(id=ADMIN_ID))]
+
+    def send_message(self, chat_id, text, **kwargs):
+        self._call('send_message')
+        return SimpleNamespace(message_id=next(self._message_ids), chat_id=chat_id, text=text)
+
+    def delete_message(self, chat_id, message_id, **kwargs):
+        self._call('delete_message')
+        return True
+
+    def kick_chat_member(self, chat_id, user_id, **kwargs):
+        self._call('kick_chat_member')
+        return True
+
+    def restrict_chat_member(self, chat_id, user_id, **kwargs):
+        self._call('restrict_chat_member')
+        return True
+
+
+class StubCMCSession(object):
+    """ Stands in for the requests session of PriceService """
+
+    def __init__(self):
+        self.requests = 0
+
+    def get(self, url, params=None, timeout=None):
+        self.requests += 1
+        quote = {'price': 0.25, 'volume_24h': 1.5e6, 'percent_change_24h': 2.5,
+                 'market_cap': 5e7}
+        data = dict(
+            (cmc_id, {'quote': dict((c, quote) for c in params['convert'].split(','))})
+            for cmc_id in params['id'].split(','))
+        return SimpleNamespace(status_code=200, json=lambda: {'data': data})
+
+
+class Stream(object):
+    """ Builds Bot API update dicts with increasing ids and timestamps """
+
+    def __init__(self):
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+
+    def user(self, user_id, first_name=None, username=None):
+        return {
+            'id': user_id,
+            'is_bot': False,
+            'first_name': first_name or 'user{}'.format(user_id),
+            'username': username,
+        }
+
+    def message(self, chat_id, user, text=None, new_chat_members=None):
+        message = {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'supergroup', 'title': 'bench'},
+            'from': user,
+        }
+        if text is not None:
+            message['text'] = text
+            if text.startswith('/'):
+                command = text.split()[0]
+                message['entities'] = [
+                    {'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        if new_chat_members is not None:
+            message['new_chat_members'] = new_chat_members
+        return {'update_id': next(self.update_ids), 'message': message}
+
+
+def scenario_normal(n, rng):
+    """ Regular chatter from a few hundred users, 2% spam """
+    stream = Stream()
+    users = [stream.user(i) for i in range(1000, 1300)]
+    updates = []
+    for _ in range(n):
+        text = rng.choice(SPAM_TEXTS if rng.random() < 0.02 else NORMAL_TEXTS)
+        updates.append(stream.message(rng.choice(CHAT_IDS), rng.choice(users), text))
+    return updates
+
+
+def scenario_raid(n, rng):
+    """ One chat flooded with spam from fresh accounts, some with banned names """
+    stream = Stream()
+    updates = []
+    for i in range(n):
+        user = stream.user(
+            200000 + i,
+            username='support{}_admin'.format(i) if i % 7 == 0 else None)
+        if i % 3 == 0:
+            updates.append(stream.message(CHAT_IDS[0], user, new_chat_members=[user]))
+        updates.append(stream.message(CHAT_IDS[0], user, rng.choice(SPAM_TEXTS)))
+    return updates[:n]
+
+
+def scenario_new_users(n, rng):
+    """ Many users joining and posting once, each needing a database upsert """
+    stream = Stream()
+    updates = []
+    for i in range(n // 2):
+        user = stream.user(400000 + i)
+        chat_id = rng.choice(CHAT_IDS)
+        updates.append(stream.message(chat_id, user, new_chat_members=[user]))
+        updates.append(stream.message(chat_id, user, rng.choice(NORMAL_TEXTS)))
+    return updates
+
+
+def scenario_price_storm(n, rng):
+    """ /price commands from many users across chats """
+    stream = Stream()
+    users = [stream.user(i) for i in range(1000, 1100)]
+    return [
+        stream.message(rng.choice(CHAT_IDS), rng.choice(users), rng.choice(PRICE_COMMANDS))
+        for _ in range(n)
+    ]
+
+
+# name: (builder, whether raid detection stays on)
+SCENARIOS = {
+    'normal': (scenario_normal, False),
+    'raid': (scenario_raid, True),
+    'new_users': (scenario_new_users, False),
+    'price_storm': (scenario_price_storm, False),
+}
+
+
+def configure_environment():
+    """ Settings must be in place before bot and model are imported """
+    for key, value in BENCH_ENV.items():
+        os.environ.setdefault(key, value)
+    if not os.environ.get('TELEGRAM_BOT_POSTGRES_URL'):
+        path = os.path.join(tempfile.mkdtemp(prefix='bench-pipeline-'), 'bench.db')
+        os.environ['TELEGRAM_BOT_POSTGRES_URL'] = 'sqlite:///{}'.format(path)
+
+
+class Harness(object):
+    """ A TelegramMonitorBot wired to the stubs, with its workers running """
+
+    def __init__(self, raid_detection):
+        import bot as bot_module
+
+        self.bot_module = bot_module
+        self.stub = StubBot()
+        self.monitor = bot_module.TelegramMonitorBot()
+        self.monitor.bot = self.stub
+        self.monitor.outbox.bot = self.stub
+        if self.monitor.prices is not None:
+            self.monitor.prices._session = StubCMCSession()
+        if not raid_detection:
+            self.monitor.raids.max_messages = sys.maxsize
+            self.monitor.raids.max_new_users = sys.maxsize
+        # Each run starts with cold caches
+        self.monitor.get_admin_ids.cache.clear()
+
+    def start(self):
+        self.monitor.outbox.start()
+        self.monitor.enrichment.start()
+        self.monitor.writer.start()
+
+    def stop(self):
+        self.monitor.outbox.stop()
+        self.monitor.writer.stop()
+        self.monitor.enrichment.stop(timeout=30)
+
+    def dispatch(self, update):
+        """ Route an update the way start() registers the handlers """
+        try:
+            self.monitor.prefilter(self.stub, update)
+        except self.bot_module.DispatcherHandlerStop:
+            return
+        command = self.bot_module.command_from_message(update.effective_message)
+        if command and command[1:].split('@')[0] in self.monitor.available_commands:
+            self.monitor.handle_command(self.stub, update)
+        else:
+            self.monitor.logger(self.stub, update)
+
+    def drain(self, timeout=60):
+        """ Write buffered rows and wait for queued enrichment and API calls """
+        deadline = time.time() + timeout
+        self.monitor.writer.flush()
+        while (self.monitor.enrichment.depth or self.monitor.outbox.depth) \
+                and time.time() < deadline:
+            time.sleep(0.01)
+        self.monitor.writer.flush()
+
+
+def parse_updates(raw, stub):
+    import telegram
+    return [telegram.Update.de_json(data, stub) for data in raw]
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def timed_run(raw, raid_detection):
+    import metrics
+
+    harness = Harness(raid_detection)
+    updates = parse_updates(raw, harness.stub)
+    harness.start()
+    metrics.REGISTRY.reset()
+
+    latencies = []
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        start = time.perf_counter()
+        for update in updates:
+            t = time.perf_counter()
+            harness.dispatch(update)
+            latencies.append(time.perf_counter() - t)
+        elapsed = time.perf_counter() - start
+        drain_start = time.perf_counter()
+        harness.drain()
+        drain = time.perf_counter() - drain_start
+        harness.stop()
+
+    latencies.sort()
+    stages = {}
+    for key, values in metrics.STAGE_SECONDS.snapshot().items():
+        stages[key] = {
+            'count': values['count'],
+            'p50_ms': (values['p50'] or 0) * 1000,
+            'p99_ms': (values['p99'] or 0) * 1000,
+        }
+    return {
+        'updates': len(updates),
+        'updates_per_sec': len(updates) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'drain_sec': drain,
+        'stages': stages,
+        'api_calls': dict(harness.stub.calls),
+    }
+
+
+def traced_run(raw, raid_detection):
+    """ Memory retained and allocated per update, from tracemalloc """
+    harness = Harness(raid_detection)
+    updates = parse_updates(raw, harness.stub)
+    harness.start()
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        for update in updates:
+            harness.dispatch(update)
+        harness.drain()
+        gc.collect()
+        after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        harness.stop()
+
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    diff = after.filter_traces(ignore).compare_to(before.filter_traces(ignore), 'filename')
+    n = float(len(updates)) or 1.0
+    return {
+        'retained_bytes_per_update': sum(s.size_diff for s in diff) / n,
+        'retained_blocks_per_update': sum(s.count_diff for s in diff) / n,
+        'peak_bytes_per_update': peak / n,
+    }
+
+
+def report(name, result):
+    print('{:<12} {:>6} updates {:>9.0f} upd/s   p50 {:.3f} ms   p99 {:.3f} ms   drain {:.2f} s'.format(
+        name, result['updates'], result['updates_per_sec'],
+        result['p50_ms'], result['p99_ms'], result['drain_sec']))
+    for stage, values in sorted(result['stages'].items()):
+        print('    {:<20} {:>7} calls   p50 {:8.3f} ms   p99 {:8.3f} ms'.format(
+            stage, values['count'], values['p50_ms'], values['p99_ms']))
+    if 'retained_bytes_per_update' in result:
+        print('    memory: {:.0f} B and {:.1f} blocks retained per update, peak {:.0f} B per update'.format(
+            result['retained_bytes_per_update'], result['retained_blocks_per_update'],
+            result['peak_bytes_per_update']))
+    print('    Bot API calls: {}'.format(result['api_calls']))
+
+
+def compare(results, baseline, tolerance):
+    """ Names of scenarios whose throughput dropped more than tolerance """
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        change = result['updates_per_sec'] / before['updates_per_sec'] - 1
+        print('{:<12} {:+.1%} updates/sec against baseline'.format(name, change))
+        if change < -tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('scenarios', nargs='*',
+                        help='scenarios to run: {} (all by default)'.format(
+                            ', '.join(sorted(SCENARIOS))))
+    parser.add_argument('-n', '--updates', type=int, default=2000,
+                        help='updates per scenario')
+    parser.add_argument('--replay', help='JSON lines file of recorded updates')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip the tracemalloc pass')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of earlier results')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed throughput drop against --compare')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error('unknown scenarios: {}'.format(', '.join(sorted(unknown))))
+
+    configure_environment()
+    # Importing the bot creates the database engine
+    import bot  # noqa: F401
+    import model
+    model.Base.metadata.create_all(model.engine)
+    print('Database: {}'.format(model.engine.url))
+
+    runs = []
+    if args.replay:
+        with open(args.replay) as f:
+            raw = [json.loads(line) for line in f if line.strip()]
+        runs.append(('replay', raw, True))
+    else:
+        for name in args.scenarios or sorted(SCENARIOS):
+            build, raid_detection = SCENARIOS[name]
+            runs.append((name, build(args.updates, random.Random(args.seed)), raid_detection))
+
+    results = {}
+    for name, raw, raid_detection in runs:
+        result = timed_run(raw, raid_detection)
+        if not args.no_memory:
+            result.update(traced_run(raw, raid_detection))
+        results[name] = result
+        report(name, result)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print('Throughput regressed in: {}'.format(', '.join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Compare the update pre-filter against the old list lookups
+
+The logger used to check `user_id in ignore_user_ids` and
+`chat_id not in chat_ids` on lists.  RuleSet.admit does both on
+frozensets.  Run from the repo root:
+
+    python benchmarks/bench_prefilter.py
+
+"""
+
+import os
+import random
+import sys
+import timeit
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rules import compile_rules
+
+random.seed(1)
+
+
+def updates(count, chat_ids, ignored, other_chats):
+    result = []
+    for _ in range(count):
+        r = random.random()
+        if r < 0.2:
+            chat_id = random.choice(other_chats)
+        else:
+            chat_id = random.choice(chat_ids)
+        if r > 0.9:
+            user_id = random.choice(ignored)
+        else:
+            user_id = random.randint(10 ** 8, 10 ** 9)
+        result.append(SimpleNamespace(
+            effective_chat=SimpleNamespace(id=chat_id),
+            effective_user=SimpleNamespace(id=user_id)))
+    return result
+
+
+def main():
+    for chats, ignores in ((5, 10), (50, 1000), (200, 20000)):
+        chat_ids = [-10 ** 12 - i for i in range(chats)]
+        ignored = random.sample(range(10 ** 6, 10 ** 8), ignores)
+        other_chats = [-10 ** 11 - i for i in range(50)]
+        ruleset = compile_rules({
+            'CHAT_IDS': ','.join(map(str, chat_ids)),
+            'IGNORE_USER_IDS': ','.join(map(str, ignored)),
+        })
+        stream = updates(10000, chat_ids, ignored, other_chats)
+
+        def lists():
+            for update in stream:
+                if update.effective_user.id in ignored:
+                    continue
+                if update.effective_chat.id not in chat_ids:
+                    continue
+
+        def admit():
+            current = ruleset
+            for update in stream:
+                chat = update.effective_chat
+                user = update.effective_user
+                current.admit(
+                    chat.id if chat is not None else None,
+                    user.id if user is not None else None)
+
+        print('{} chats, {} ignored users'.format(chats, ignores))
+        for name, fn in (('lists', lists), ('admit', admit)):
+            runs = timeit.repeat(fn, number=3, repeat=3)
+            per_update = min(runs) / (3 * len(stream))
+            print('    {:<6} {:8.3f} us/update'.format(name, per_update * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""Measure how long importing the bot takes
+
+Runs `python -X importtime -c "import bot"` in a fresh interpreter and
+prints the total import time, the slowest top level imports, and the
+cumulative time of the heavy modules imported anywhere below them.
+
+    python benchmarks/bench_startup.py
+
+"""
+
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Reported wherever they are first imported, however deeply nested
+WATCHED = (
+    'telegram', 'telegram.ext', 'sqlalchemy', 'model', 'metrics', 'confusables',
+    'unidecode', 'enrichment', 'googletrans', 'textblob', 'requests', 'prices',
+)
+
+
+def main():
+    env = dict(os.environ)
+    env.setdefault('TELEGRAM_BOT_POSTGRES_URL', 'postgresql://localhost/postgres')
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import bot'],
+        cwd=ROOT, env=env, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL,
+        universal_newlines=True)
+    if result.returncode != 0:
+        print(result.stderr)
+        sys.exit(result.returncode)
+
+    # Lines look like: "import time:  self [us] | cumulative | imported package"
+    top_level = []
+    cumulative_by_name = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '):
+            top_level.append((int(cumulative), name.strip()))
+        cumulative_by_name[name.strip()] = int(cumulative)
+
+    total = sum(us for us, _ in top_level)
+    print('Total import time: {:.0f} ms'.format(total / 1000.0))
+    print('Slowest top level imports:')
+    for us, name in sorted(top_level, reverse=True)[:10]:
+        print('{:>8.1f} ms  {}'.format(us / 1000.0, name))
+    print('Cumulative time of watched modules:')
+    for name in WATCHED:
+        if name in cumulative_by_name:
+            print('{:>8.1f} ms  {}'.format(cumulative_by_name[name] / 1000.0, name))
+        else:
+            print('{:>8}     {}'.format('-', name))
+
+
+if __name__ == '__main__':
+    main()
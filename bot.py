@@ -10,50 +10,68 @@ This bot logs all messages sent in a Telegram Group to a database.
 """
 
 #from __future__ import print_function
+import time
+STARTED = time.time()
+
 import os
 import sys
-import re
-import unidecode
 import locale
+import threading
 import traceback
 from time import strftime
-from datetime import datetime, timedelta
 
-import requests
 import telegram
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
-from model import User, Message, MessageHide, UserBan, session
+from telegram.ext import (Updater, CommandHandler, MessageHandler, TypeHandler, Filters,
+    DispatcherHandlerStop)
+from model import (User, Message, MessageHide, UserBan, RaidSummary,
+    init_engine, insert_ignore, pool_stats, session_scope)
+import metrics
 from mwt import MWT
-from googletrans import Translator
-from textblob import TextBlob
+import confusables
+from enrichment import EnrichmentQueue, enricher_from_env
+from writer import BatchWriter
+from usercache import KnownUserCache
+from webhook import MAX_BODY_SIZE, WebhookServer
+from rules import UNMONITORED, store_from_env
+from sharding import shard_for
+from decisioncache import ContentCache
+from adminrefresh import AdminRefresher
+from outbox import ActionQueue
+from raid import RaidDetector
+from flood import FLOOD_STARTED, FloodDetector
+from migrations import schedule_maintenance
+from prices import CMC_API_KEY, CMC_SYMBOL_TO_NAME, PriceService
 
 # Used with monetary formatting
 locale.setlocale(locale.LC_ALL, '')
 
-# Price data cache duration
-CACHE_DURATION = timedelta(minutes=15)
+# Worker threads of the dispatcher, which only run @run_async handlers
+dispatcher_workers = int(os.environ.get('DISPATCHER_WORKERS', 4))
+
+
+def intake_concurrency(environ):
+    """ Number of update handlers that may run at once """
+    intake_mode = environ.get('INTAKE_MODE', 'polling').lower()
+    if intake_mode == 'webhook':
+        return int(environ.get('WEBHOOK_CONCURRENCY', 8))
+    # Polling and shards run every handler on the dispatcher thread
+    return 1
+
 
-# CMC IDs can be retrived at:
-# https://pro-api.coinmarketcap.com/v1/cryptocurrency/map?symbol=[SYMBOL]
-CMC_SYMBOL_TO_ID = {
-    'OGN': 5117,
-    'USDT': 825,
-    'USDC': 3408,
-    'DAI': 4943,
-}
-CMC_API_KEY = os.environ.get('CMC_API_KEY')
-CMC_USD_QUOTE_URL = 'https://pro-api.coinmarketcap.com/v1/cryptocurrency/quotes/latest?id={}'
-CMC_BTC_QUOTE_URL = 'https://pro-api.coinmarketcap.com/v1/cryptocurrency/quotes/latest?id={}&convert=BTC'
+# Enough connections for every thread that talks to the database: the
+# update handlers, the enrichment workers, the batch writer, and one for
+# the user cache warm-up and partition maintenance
+init_engine(pool_size=int(os.environ.get(
+    'DB_POOL_SIZE',
+    intake_concurrency(os.environ) + int(os.environ.get('ENRICH_WORKERS', 2)) + 2)))
 
 
 def first_of(attr, match, it):
     """ Return the first item in a set with an attribute that matches match """
     if it is not None:
         for i in it:
-            try:
-                if getattr(i, attr) == match:
-                    return i
-            except: pass
+            if getattr(i, attr, None) == match:
+                return i
 
     return None
 
@@ -74,23 +92,6 @@ def command_from_message(message, default=None):
     return command or default
 
 
-def cmc_get_data(jso, cmc_id, pair_symbol='USD'):
-    """ Pull relevant data from a response object """
-    if not jso:
-        return None
-
-    data = jso.get('data', {})
-    specific_data = data.get(str(cmc_id), {})
-    quote = specific_data.get('quote', {})
-    symbol_data = quote.get(pair_symbol, {})
-    return {
-        'price': symbol_data.get('price'),
-        'volume': symbol_data.get('volume_24h'),
-        'percent_change': symbol_data.get('percent_change_24h'),
-        'market_cap': symbol_data.get('market_cap'),
-    }
-
-
 def decimal_format(v, decimals=2):
     if not v:
         v = 0
@@ -106,107 +107,6 @@ def btc_format(v):
 
 
 
-class TokenData:
-    def __init__(self, symbol, price=None, stamp=datetime.now()):
-        self.symbol = symbol
-        self._price = price
-        self._btc_price = 0
-        self._percent_change = 0
-        self._btc_percent_change = 0
-        self._volume = 0
-        self._market_cap = 0
-        if price is not None:
-            self.stamp = stamp
-        else:
-            self.stamp = None
-
-    def _fetch_from_cmc(self, url_template):
-        """ Get quote data for a specific known symbol """
-        jso = None
-
-        cmc_id = CMC_SYMBOL_TO_ID.get(self.symbol)
-        url = url_template.format(cmc_id)
-        r = requests.get(url, headers={
-            'X-CMC_PRO_API_KEY': CMC_API_KEY,
-            'Accept': 'application/json',
-        })
-        if r.status_code != 200:
-            print('Failed to fetch price data for id: {}'.format(cmc_id))
-            return None
-        try:
-            jso = r.json()
-        except Exception:
-            print('Error parsing JSON')
-            return None
-        return jso
-
-    def update(self):
-        """ Fetch price from binance """
-        jso = None
-        data = None
-        if self.stamp is None or (
-            self.stamp is not None
-            and self.stamp < datetime.now() - CACHE_DURATION
-        ):
-            # CMC USD
-            try:
-                jso = self._fetch_from_cmc(CMC_USD_QUOTE_URL)
-                data = cmc_get_data(jso, CMC_SYMBOL_TO_ID[self.symbol])
-            except Exception as err:
-                print('Error fetching data: ', str(err))
-                print(traceback.format_exc())
-            if data is not None:
-                self._price = data.get('price')
-                self._percent_change = data.get('percent_change')
-                self._volume = data.get('volume')
-                self._market_cap = data.get('market_cap')
-                self.stamp = datetime.now()
-
-            # CMC BTC
-            try:
-                jso = self._fetch_from_cmc(CMC_BTC_QUOTE_URL)
-                data = cmc_get_data(jso, CMC_SYMBOL_TO_ID[self.symbol], 'BTC')
-            except Exception as err:
-                print('Error fetching data: ', str(err))
-                print(traceback.format_exc())
-            if data is not None:
-                self._btc_price = data.get('price')
-                self._btc_percent_change = data.get('percent_change')
-
-    @property
-    def price(self):
-        self.update()
-        return self._price
-
-    @property
-    def btc_price(self):
-        self.update()
-        return self._btc_price
-
-    @property
-    def btc_percent_change(self):
-        self.update()
-        return self._btc_percent_change
-
-    @property
-    def volume(self):
-        self.update()
-        return self._volume
-
-    @property
-    def percent_change(self):
-        self.update()
-        pc = str(self._percent_change)
-        if pc and not pc.startswith('-'):
-            pc = '+{}'.format(pc)
-        return pc
-
-    @property
-    def market_cap(self):
-        self.update()
-        return self._market_cap
-
-
 class TelegramMonitorBot:
 
 
@@ -226,50 +126,25 @@ class TelegramMonitorBot:
             print("🔵 TELEGRAM_BOT_POSTGRES_URL:", os.environ["TELEGRAM_BOT_POSTGRES_URL"])
             print("🔵 TELEGRAM_BOT_TOKEN:", os.environ["TELEGRAM_BOT_TOKEN"])
             print("🔵 NOTIFY_CHAT:", os.environ['NOTIFY_CHAT'] if 'NOTIFY_CHAT' in os.environ else "<undefined>")
-            print("🔵 MESSAGE_BAN_PATTERNS:\n", os.environ['MESSAGE_BAN_PATTERNS'])
-            print("🔵 MESSAGE_HIDE_PATTERNS:\n", os.environ['MESSAGE_HIDE_PATTERNS'])
-            print("🔵 NAME_BAN_PATTERNS:\n", os.environ['NAME_BAN_PATTERNS'])
+            print("🔵 MESSAGE_BAN_PATTERNS:\n", os.environ.get('MESSAGE_BAN_PATTERNS'))
+            print("🔵 MESSAGE_HIDE_PATTERNS:\n", os.environ.get('MESSAGE_HIDE_PATTERNS'))
+            print("🔵 NAME_BAN_PATTERNS:\n", os.environ.get('NAME_BAN_PATTERNS'))
             print("🔵 IGNORE_USER_IDS:\n", os.environ.get('IGNORE_USER_IDS'))
+            print("🔵 RULES_FILE:", os.environ.get('RULES_FILE', "<undefined>"))
 
         # Channel to notify of violoations, e.g. '@channelname'
         self.notify_chat = os.environ['NOTIFY_CHAT'] if 'NOTIFY_CHAT' in os.environ else None
 
-        # Ignore these user IDs
-        if not os.environ.get('IGNORE_USER_IDS'):
-            self.ignore_user_ids = []
-        else:
-            self.ignore_user_ids = list(map(int, os.environ['IGNORE_USER_IDS'].split(',')))
-
-        # List of chat ids that bot should monitor
-        self.chat_ids = (
-            list(map(int, os.environ['CHAT_IDS'].split(',')))
-            if "CHAT_IDS" in os.environ else [])
-
-        # Regex for message patterns that cause user ban
-        self.message_ban_patterns = os.environ['MESSAGE_BAN_PATTERNS']
-        self.message_ban_re = (re.compile(
-            self.message_ban_patterns,
-            re.IGNORECASE | re.VERBOSE)
-            if self.message_ban_patterns else None)
-
-        # Regex for message patterns that cause message to be hidden
-        self.message_hide_patterns = os.environ['MESSAGE_HIDE_PATTERNS']
-        self.message_hide_re = (re.compile(
-            self.message_hide_patterns,
-            re.IGNORECASE | re.VERBOSE)
-            if self.message_hide_patterns else None)
-
-        # Regex for name patterns that cause user to be banned
-        self.name_ban_patterns = os.environ['NAME_BAN_PATTERNS']
-        self.name_ban_re = (re.compile(
-            self.name_ban_patterns,
-            re.IGNORECASE | re.VERBOSE)
-            if self.name_ban_patterns else None)
-
-        # Mime type document check
-        # NOTE: All gifs appear to be converted to video/mp4
-        mime_types = os.environ.get('ALLOWED_MIME_TYPES', 'video/mp4')
-        self.allowed_mime_types = set(map(lambda s: s.strip(), mime_types.split(',')))
+        # Monitored chats, and ban/hide patterns, allowed mime types and
+        # ignored users per chat. Compiled from the environment and
+        # RULES_FILE, reloaded on change.
+        self.rules = store_from_env(os.environ)
+
+        # (index, count) when running as one of several shards
+        self.shard = None
+
+        # Unmonitored chats already reported in the log
+        self.reported_chats = set()
 
         # Comamnds
         self.available_commands = ['flip', 'unflip']
@@ -278,177 +153,277 @@ class TelegramMonitorBot:
 
         print('Available commands: {}'.format(', '.join(self.available_commands)))
 
-        # Cached token prices
-        self.cached_prices = {}
-        self.last_message_out = None
+        # Token prices, refreshed in the background
+        self.prices = PriceService() if CMC_API_KEY is not None else None
+        self.price_messages = {}
+
+        # Last price message sent, per (chat_id, symbol)
+        self.last_message_out = {}
+
+        # Normalized text, verdicts and translations of recently seen messages
+        self.content_cache = ContentCache(
+            maxsize=int(os.environ.get('CONTENT_CACHE_SIZE', 10000)),
+            ttl=int(os.environ.get('CONTENT_CACHE_TTL', 60*60)))
+
+        # Background translation and sentiment analysis of logged messages
+        self.enrichment = EnrichmentQueue(
+            enricher_from_env(os.environ),
+            cache=self.content_cache,
+            workers=int(os.environ.get('ENRICH_WORKERS', 2)),
+            maxsize=int(os.environ.get('ENRICH_QUEUE_SIZE', 1000)),
+            max_retries=int(os.environ.get('ENRICH_MAX_RETRIES', 2)),
+            batch_size=int(os.environ.get('ENRICH_BATCH_SIZE', 20)),
+            batch_wait=float(os.environ.get('ENRICH_BATCH_WAIT', 0.5)))
+
+        # Switches chats under a message or new user flood to a fast path
+        self.raids = RaidDetector(
+            window=int(os.environ.get('RAID_WINDOW', 10)),
+            max_messages=int(os.environ.get('RAID_MAX_MESSAGES', 100)),
+            max_new_users=int(os.environ.get('RAID_MAX_NEW_USERS', 20)),
+            cooldown=int(os.environ.get('RAID_COOLDOWN', 120)),
+            on_end=lambda summary: self.writer.add(RaidSummary, **summary))
+
+        # Per user message rate limit
+        self.floods = FloodDetector(
+            window=int(os.environ.get('FLOOD_WINDOW', 10)),
+            max_messages=int(os.environ.get('FLOOD_MAX_MESSAGES', 10)),
+            maxsize=int(os.environ.get('FLOOD_MAX_TRACKED', 200000)))
+        self.flood_action = os.environ.get('FLOOD_ACTION', 'hide').lower()
+        self.flood_mute_seconds = int(os.environ.get('FLOOD_MUTE_SECONDS', 10*60))
+
+        # Rate limited deletes, bans, replies and notifications
+        self.outbox = ActionQueue(
+            workers=int(os.environ.get('OUTBOX_WORKERS', 4)),
+            global_rate=float(os.environ.get('OUTBOX_GLOBAL_RATE', 30)),
+            chat_rate=float(os.environ.get('OUTBOX_CHAT_RATE', 1)),
+            chat_burst=int(os.environ.get('OUTBOX_CHAT_BURST', 20)),
+            moderation_rate=float(os.environ.get('OUTBOX_MODERATION_RATE', 200)),
+            digest_interval=float(os.environ.get('NOTIFY_DIGEST_INTERVAL', 10)))
+
+        # Keep admin lists of monitored chats warm, using the bot set in start()
+        self.bot = None
+        self.admin_refresher = AdminRefresher(
+            self.get_admin_ids.cache,
+            lambda chat_id: self.fetch_admin_ids(self.bot, chat_id),
+            self.monitored_chat_ids,
+            interval=int(os.environ.get('ADMIN_REFRESH_INTERVAL', 10*60)))
+
+        # IDs of users already stored in telegram_users
+        self.known_users = KnownUserCache(
+            maxsize=int(os.environ.get('KNOWN_USERS_CACHE_SIZE', 100000)))
+
+        # Buffered multi-row inserts of logged messages, hides and bans
+        self.writer = BatchWriter(
+            max_rows=int(os.environ.get('DB_BATCH_SIZE', 500)),
+            max_delay=float(os.environ.get('DB_BATCH_DELAY', 1.0)))
+
+
+    @property
+    def chat_ids(self):
+        """ IDs of the chats the bot should monitor """
+        return self.rules.current.chat_ids
+
+
+    def monitored_chat_ids(self):
+        """ Monitored chats handled by this process """
+        if self.shard is None:
+            return sorted(self.chat_ids)
+        index, shards = self.shard
+        return sorted(c for c in self.chat_ids if shard_for(c, shards) == index)
 
 
-    @MWT(timeout=60*60)
+    @MWT(timeout=60*60, key=lambda self, bot, chat_id: chat_id)
     def get_admin_ids(self, bot, chat_id):
-        """ Returns a list of admin IDs for a given chat. Results are cached for 1 hour. """
-        return [admin.user.id for admin in bot.get_chat_administrators(chat_id)]
+        """ Returns a list of admin IDs for a given chat. Results are cached for 1 hour
+        and kept fresh in the background by AdminRefresher. """
+        return self.fetch_admin_ids(bot, chat_id)
+
+
+    def fetch_admin_ids(self, bot, chat_id):
+        """ Fetch the list of admin IDs for a given chat from Telegram """
+        with metrics.timed('telegram_api'):
+            admins = bot.get_chat_administrators(chat_id)
+        return [admin.user.id for admin in admins]
 
 
     def ban_user(self, update):
         """ Ban user """
-        kick_success = update.message.chat.kick_member(update.message.from_user.id)
+        self.outbox.kick(update.message.chat_id, update.message.from_user.id)
 
 
-    def security_check_username(self, bot, update):
+    def security_check_username(self, bot, update, rules=None):
         """ Test username for security violations """
+        rules = rules or self.rules.for_chat(update.message.chat_id)
 
         full_name = "{} {}".format(
             update.message.from_user.first_name,
             update.message.from_user.last_name)
-        if self.name_ban_re and self.name_ban_re.search(full_name):
+        with metrics.timed('regex'):
+            full_name_verdict = rules.name_matcher.match(confusables.normalize(full_name))
+            username_verdict = rules.name_matcher.match(
+                confusables.normalize(update.message.from_user.username or ''))
+
+        if full_name_verdict == 'ban':
             # Logging
             log_message = "❌ 🙅‍♂️ BAN MATCH FULL NAME: {}".format(full_name.encode('utf-8'))
             if self.debug:
-                update.message.reply_text(log_message)
+                # Not a reply, as the message may be deleted before this is sent
+                self.outbox.send(update.message.chat_id, log_message)
             print(log_message)
             # Ban the user
             self.ban_user(update)
             # Log in database
-            s = session()
-            userBan = UserBan(
+            self.writer.add(
+                UserBan,
                 user_id=update.message.from_user.id,
                 reason=log_message)
-            s.add(userBan)
-            s.commit()
-            s.close()
             # Notify channel
             if self.notify_chat:
-                bot.send_message(chat_id=self.notify_chat, text=log_message)
+                self.outbox.notify(self.notify_chat, log_message)
 
-        if self.name_ban_re and self.name_ban_re.search(update.message.from_user.username or ''):
+        if username_verdict == 'ban':
             # Logging
             log_message = "❌ 🙅‍♂️ BAN MATCH USERNAME: {}".format(update.message.from_user.username.encode('utf-8'))
             if self.debug:
-                update.message.reply_text(log_message)
+                self.outbox.send(update.message.chat_id, log_message)
             print(log_message)
             # Ban the user
             self.ban_user(update)
             # Log in database
-            s = session()
-            userBan = UserBan(
+            self.writer.add(
+                UserBan,
                 user_id=update.message.from_user.id,
                 reason=log_message)
-            s.add(userBan)
-            s.commit()
-            s.close()
             # Notify channel
             if self.notify_chat:
-                bot.send_message(chat_id=self.notify_chat, text=log_message)
+                self.outbox.notify(self.notify_chat, log_message)
 
 
-    def security_check_message(self, bot, update):
+    def security_check_message(self, bot, update, rules=None):
         """ Test message for security violations """
 
         if not update.message.text:
             return
-
-        # Remove accents from letters (é->e, ñ->n, etc...)
-        message = unidecode.unidecode(update.message.text)
-        # TODO: Replace lookalike unicode characters:
-        # https://github.com/wanderingstan/Confusables
+        rules = rules or self.rules.for_chat(update.message.chat_id)
+
+        # Exact duplicates (spam waves) reuse the earlier result
+        cached = self.content_cache.get(update.message.text, rules.cache_field)
+        if cached is None:
+            with metrics.timed('regex'):
+                # Replace lookalike characters and remove accents (é->e, ñ->n, etc...)
+                message = confusables.normalize(update.message.text)
+                verdict = rules.message_matcher.match(message)
+            self.content_cache.set(
+                update.message.text, rules.cache_field, (message, verdict))
+        else:
+            message, verdict = cached
 
         # Hide forwarded messages
         if update.message.forward_date is not None:
             # Logging
             log_message = "❌ HIDE FORWARDED: {}".format(update.message.text.encode('utf-8'))
             if self.debug:
-                update.message.reply_text(log_message)
+                self.outbox.send(update.message.chat_id, log_message)
             print(log_message)
             # Delete the message
-            update.message.delete()
+            self.outbox.delete(update.message.chat_id, update.message.message_id)
             # Log in database
-            s = session()
-            messageHide = MessageHide(
+            self.writer.add(
+                MessageHide,
                 user_id=update.message.from_user.id,
                 message=update.message.text)
-            s.add(messageHide)
-            s.commit()
-            s.close()
             # Notify channel
             if self.notify_chat:
-                bot.send_message(chat_id=self.notify_chat, text=log_message)
+                self.outbox.notify(self.notify_chat, log_message)
 
-        if self.message_ban_re and self.message_ban_re.search(message):
+        if verdict == 'ban':
             # Logging
             log_message = "❌ 🙅‍♂️ BAN MATCH: {}".format(update.message.text.encode('utf-8'))
             if self.debug:
-                update.message.reply_text(log_message)
+                self.outbox.send(update.message.chat_id, log_message)
             print(log_message)
             # Any message that causes a ban gets deleted
-            update.message.delete()
+            self.outbox.delete(update.message.chat_id, update.message.message_id)
             # Ban the user
             self.ban_user(update)
             # Log in database
-            s = session()
-            userBan = UserBan(
+            self.writer.add(
+                UserBan,
                 user_id=update.message.from_user.id,
                 reason=update.message.text)
-            s.add(userBan)
-            s.commit()
-            s.close()
             # Notify channel
             if self.notify_chat:
-                bot.send_message(chat_id=self.notify_chat, text=log_message)
+                self.outbox.notify(self.notify_chat, log_message)
 
-        elif self.message_hide_re and self.message_hide_re.search(message):
+        elif verdict == 'hide':
             # Logging
             log_message = "❌ 🙈 HIDE MATCH: {}".format(update.message.text.encode('utf-8'))
             if self.debug:
-                update.message.reply_text(log_message)
+                self.outbox.send(update.message.chat_id, log_message)
             print(log_message)
             # Delete the message
-            update.message.delete()
+            self.outbox.delete(update.message.chat_id, update.message.message_id)
             # Log in database
-            s = session()
-            messageHide = MessageHide(
+            self.writer.add(
+                MessageHide,
                 user_id=update.message.from_user.id,
                 message=update.message.text)
-            s.add(messageHide)
-            s.commit()
-            s.close()
             # Notify channel
             if self.notify_chat:
-                bot.send_message(chat_id=self.notify_chat, text=log_message)
+                self.outbox.notify(self.notify_chat, log_message)
+
 
+    def has_hidden_attachment(self, message, rules):
+        """ Whether message has an attachment other than a photo, video or
+        allowed document type """
+        if message.document:
+            # GIFs are documents and allowed
+            mime_type = message.document.mime_type
+            return not (mime_type and mime_type in rules.allowed_mime_types)
+        return bool(message.audio or message.game or message.voice)
 
-    def attachment_check(self, bot, update):
+    def attachment_check(self, bot, update, rules=None):
         """ Hide messages with attachments (except photo or video) """
-        if (update.message.audio or
-            update.message.document or
-            update.message.game or
-            update.message.voice):
+        rules = rules or self.rules.for_chat(update.message.chat_id)
+        if self.has_hidden_attachment(update.message, rules):
             # Logging
             if update.message.document:
-                # GIFs are documents and allowed
-                mime_type = update.message.document.mime_type
-                if mime_type and mime_type in self.allowed_mime_types:
-                    return
                 log_message = "❌ HIDE DOCUMENT: {}".format(update.message.document.__dict__)
             else:
                 log_message = "❌ HIDE NON-DOCUMENT ATTACHMENT"
             if self.debug:
-                update.message.reply_text(log_message)
+                self.outbox.send(update.message.chat_id, log_message)
             print(log_message)
             # Delete the message
-            update.message.delete()
+            self.outbox.delete(update.message.chat_id, update.message.message_id)
             # Log in database
-            s = session()
-            messageHide = MessageHide(
+            self.writer.add(
+                MessageHide,
                 user_id=update.message.from_user.id,
                 message=update.message.text)
-            s.add(messageHide)
-            s.commit()
-            s.close()
             # Notify channel
             if self.notify_chat:
-                bot.send_message(chat_id=self.notify_chat, text=log_message)
-
+                self.outbox.notify(self.notify_chat, log_message)
+
+
+    def prefilter(self, bot, update):
+        """ Turn away updates from other chats and ignored users before any
+        other handler, commands included, does anything with them """
+        chat = update.effective_chat
+        user = update.effective_user
+        _, rejected = self.rules.current.admit(
+            chat.id if chat is not None else None,
+            user.id if user is not None else None)
+        if rejected is None:
+            return
+        metrics.UPDATES.inc(outcome=rejected)
+        if rejected == UNMONITORED:
+            self.report_unmonitored(chat, user)
+        elif self.debug:
+            print("{}: Ignoring update.".format(update.update_id))
+        raise DispatcherHandlerStop()
 
+    @metrics.timed('logger')
     def logger(self, bot, update):
         """ Primary Logger. Handles incoming bot messages and saves them to DB
 
@@ -456,12 +431,9 @@ class TelegramMonitorBot:
         :param update: telegram.Update https://python-telegram-bot.readthedocs.io/en/stable/telegram.update.html
         """
 
-        if (
-            update.effective_user is None
-            or update.effective_user.id in self.ignore_user_ids
-        ):
-            print("{}: Ignoring update.".format(update.update_id))
-            return
+        # Only updates admitted by prefilter get here. The rules stay the
+        # same for the whole update, even if they are reloaded meanwhile.
+        rules = self.rules.for_chat(update.effective_chat.id)
 
         try:
 
@@ -472,6 +444,7 @@ class TelegramMonitorBot:
 
                 if update.effective_message is None:
                     print("No message included in update")
+                    metrics.UPDATES.inc(outcome='ignored')
                     return
 
                 message = update.effective_message
@@ -480,18 +453,25 @@ class TelegramMonitorBot:
 
                 user = message.from_user
 
-                # Limit bot to monitoring certain chats
-                if message.chat_id not in self.chat_ids:
-                    from_user = "UNKNOWN"
-                    if user:
-                        from_user = user.id
-                    print("Message from user {} is from chat_id not being monitored: {}".format(
-                        from_user,
-                        message.chat_id)
-                    )
+                # Joins and leaves update the cached admin lists, also
+                # during raids and floods when admin changes are likely
+                self.admin_refresher.observe(message)
+
+                new_users = len(message.new_chat_members or [])
+                raid = self.raids.observe(message.chat_id, new_users)
+                if raid is not None:
+                    self.raid_check(bot, update, message, rules)
+                    metrics.UPDATES.inc(outcome='raid')
+                    return
+
+                # Senders that get banned skip the flood path, so the
+                # security checks below still ban them
+                if (self.pattern_verdict(message, rules) != 'ban'
+                        and self.flood_check(bot, update, message)):
+                    metrics.UPDATES.inc(outcome='flood')
                     return
 
-                if self.id_exists(user.id):
+                if user.id in self.known_users:
                     self.log_message(user.id, message.text,
                                      message.chat_id)
                 else:
@@ -502,6 +482,7 @@ class TelegramMonitorBot:
                         user.username)
 
                     if add_user_success:
+                        self.known_users.add(user.id)
                         self.log_message(
                             user.id, message.text, message.chat_id)
                         print("User added: {}".format(user.id))
@@ -532,81 +513,159 @@ class TelegramMonitorBot:
             # Don't check admin activity
             is_admin = False
             if message:
-                is_admin = message.from_user.id in self.get_admin_ids(bot, message.chat_id)
+                with metrics.timed('admin_lookup'):
+                    is_admin = message.from_user.id in self.get_admin_ids(bot, message.chat_id)
 
             if is_admin and self.admin_exempt:
                 print("👮‍♂️ Skipping checks. User is admin: {}".format(user.id))
             else:
                 # Security checks
-                self.attachment_check(bot, update)
-                self.security_check_username(bot, update)
-                self.security_check_message(bot, update)
+                self.attachment_check(bot, update, rules)
+                self.security_check_username(bot, update, rules)
+                self.security_check_message(bot, update, rules)
+
+            metrics.UPDATES.inc(outcome='checked')
 
         except Exception as e:
+            metrics.UPDATES.inc(outcome='error')
             print("Error[521]: {}".format(e))
             print(traceback.format_exc())
             print('Error on line {}'.format(sys.exc_info()[-1].tb_lineno), type(e).__name__, e)
 
-    # DB queries
-    def id_exists(self, id_value):
-        s = session()
-        bool_set = False
-        for id1 in s.query(User.id).filter_by(id=id_value):
-            if id1:
-                bool_set = True
+    def flood_check(self, bot, update, message):
+        """ Hide (or mute their sender, with FLOOD_ACTION=mute) messages over
+        the per user rate limit. Returns True if the message was flooding. """
+        user = message.from_user
+        flood = self.floods.observe(message.chat_id, user.id)
+        if flood is None:
+            return False
+        # Admins are never limited
+        if user.id in self.get_admin_ids(bot, message.chat_id):
+            return False
+
+        self.outbox.delete(message.chat_id, message.message_id)
+        self.writer.add(
+            MessageHide,
+            user_id=user.id,
+            message=message.text)
+
+        if flood == FLOOD_STARTED:
+            # Logging
+            log_message = "❌ 🌊 FLOOD: user {} sent more than {} messages in {}s".format(
+                user.id, self.floods.max_messages, self.floods.window)
+            if self.flood_action == 'mute':
+                self.outbox.restrict(
+                    message.chat_id, user.id,
+                    until_date=int(time.time()) + self.flood_mute_seconds)
+                log_message += ", muted for {}s".format(self.flood_mute_seconds)
+            print(log_message)
+            # Notify channel
+            if self.notify_chat:
+                self.outbox.notify(self.notify_chat, log_message)
+        return True
 
-        s.close()
+    def report_unmonitored(self, chat, user):
+        """ Log the first update from each chat that isn't monitored """
+        chat_id = chat.id if chat is not None else None
+        if chat_id in self.reported_chats:
+            return
+        if len(self.reported_chats) < 10000:
+            self.reported_chats.add(chat_id)
+        print("Message from user {} is from chat_id not being monitored: {}".format(
+            user.id if user is not None else "UNKNOWN",
+            chat_id)
+        )
 
-        return bool_set
+    def raid_check(self, bot, update, message, rules):
+        """ Fast path while a chat is being raided
 
+        Only the ban/hide patterns, forwards and attachments are checked,
+        all in constant time or from the content cache. Offending messages are
+        deleted and their senders banned through the outbox, and nothing is
+        translated or logged per message; the raid's totals are stored as a
+        RaidSummary when it ends.
+        """
+        user = message.from_user
+        if self.admin_exempt and user.id in self.get_admin_ids(bot, message.chat_id):
+            return
+
+        verdict = self.pattern_verdict(message, rules)
+        if verdict is None and (
+                message.forward_date is not None
+                or self.has_hidden_attachment(message, rules)):
+            verdict = 'hide'
+
+        if verdict is not None:
+            self.outbox.delete(message.chat_id, message.message_id)
+        if verdict == 'ban':
+            self.outbox.kick(message.chat_id, user.id)
+        self.raids.record(
+            message.chat_id,
+            hidden=int(verdict == 'hide'),
+            banned=int(verdict == 'ban'))
+
+    def pattern_verdict(self, message, rules):
+        """ 'ban' or 'hide' if the message text or the sender's name matches
+        the ban/hide patterns, else None. Texts are looked up in the content
+        cache first. """
+        user = message.from_user
+        verdict = None
+        with metrics.timed('regex'):
+            if message.text:
+                cached = self.content_cache.get(message.text, rules.cache_field)
+                if cached is None:
+                    normalized = confusables.normalize(message.text)
+                    verdict = rules.message_matcher.match(normalized)
+                    self.content_cache.set(message.text, rules.cache_field, (normalized, verdict))
+                else:
+                    verdict = cached[1]
+            if verdict is None and (
+                rules.name_matcher.match(confusables.normalize(
+                    "{} {}".format(user.first_name, user.last_name))) == 'ban'
+                or rules.name_matcher.match(confusables.normalize(user.username or '')) == 'ban'
+            ):
+                verdict = 'ban'
+        return verdict
+
+    # DB queries
     def log_message(self, user_id, user_message, chat_id):
 
         if user_message is None:
             user_message = "[NO MESSAGE]"
 
         try:
-            s = session()
-            language_code = english_message = ""
-            polarity = subjectivity = 0.0
-            try:
-                # translate to English & log the original language
-                translator = Translator()
-                translated = translator.translate(user_message)
-                language_code = translated.src
-                english_message = translated.text
-                # run basic sentiment analysis on the translated English string
-                analysis = TextBlob(english_message)
-                polarity = analysis.sentiment.polarity
-                subjectivity = analysis.sentiment.subjectivity
-            except Exception as e:
-                print("Error translating message: {}".format(e))
-            msg1 = Message(user_id=user_id, message=user_message, chat_id=chat_id, 
-                language_code=language_code, english_message=english_message, polarity=polarity,
-                subjectivity=subjectivity)
-            s.add(msg1)
-            s.commit()
-            s.close()
+            # Translation and sentiment are filled in later, off the hot path
+            self.writer.add(
+                Message,
+                callback=lambda key: self.enrichment.submit(key, user_message),
+                user_id=user_id, message=user_message, chat_id=chat_id,
+                language_code="", english_message="", polarity=0.0,
+                subjectivity=0.0)
         except Exception as e:
             print("Error logging message: {}".format(e))
             print(traceback.format_exc())
 
 
     def add_user(self, user_id, first_name, last_name, username):
+        """ Upsert a user. Returns True once the user is known to exist. """
         try:
-            s = session()
-            user = User(
-                id=user_id,
-                first_name=first_name,
-                last_name=last_name,
-                username=username)
-            s.add(user)
-            s.commit()
-            s.close()
-            return self.id_exists(user_id)
+            with metrics.timed('db_lookup'), session_scope() as s:
+                s.execute(
+                    insert_ignore(
+                        User.__table__, ['id'],
+                        id=user_id,
+                        first_name=first_name,
+                        last_name=last_name,
+                        username=username,
+                    )
+                )
+            return True
         except Exception as e:
             print("Error[347]: {}".format(e))
             print(traceback.format_exc())
+            return False
 
+    @metrics.timed('command')
     def handle_command(self, bot, update):
         """ Handles commands
 
@@ -617,7 +676,7 @@ class TelegramMonitorBot:
         context: CallbackContext: https://python-telegram-bot.readthedocs.io/en/stable/telegram.ext.callbackcontext.html
 
         hi: says hi
-        price: prints the OGN price
+        price: prints the price of a token (OGN by default), or of all tokens
         """
         chat_id = None
         command = None
@@ -640,44 +699,47 @@ class TelegramMonitorBot:
             bot.send_message(chat_id, '┬──┬﻿ ¯\\_(՞▃՞ ¯\\_)')
 
         elif command == '/price':
-            """ Price, 24 hour %, 24 hour volume, and market cap """
-            symbol = 'OGN'
-            if symbol not in self.cached_prices:
-                self.cached_prices[symbol] = TokenData(symbol)
-            pdata = self.cached_prices[symbol]
-            message = """
-*Origin Token* (OGN)
-*USD Price*: {} ({}%)
-*BTC Price*: {} ({}%)
-*Market Cap*: {}
-*Volume(24h)*: {}
+            """ Price, 24 hour %, 24 hour volume, and market cap
+
+            /price [SYMBOL] shows one token, OGN by default
+            /price all shows a one line summary of every token
+            """
+            args = update.effective_message.text.split()[1:]
+            symbol = args[0].upper() if args else 'OGN'
+            if symbol == 'ALL':
+                symbols = sorted(self.prices.tokens)
+            elif symbol in self.prices.tokens:
+                symbols = [symbol]
+            else:
+                bot.send_message(chat_id, 'Unknown symbol. Try one of: {}, ALL'.format(
+                    ', '.join(sorted(self.prices.tokens))))
+                return
 
-@{}""".format(
-                monetary_format(pdata.price, decimals=5),
-                pdata.percent_change,
-                btc_format(pdata.btc_price),
-                pdata.btc_percent_change,
-                monetary_format(pdata.market_cap),
-                monetary_format(pdata.volume),
-                update.effective_user.username,
-            )
+            # Handlers share the dispatcher thread, so don't wait long on CMC
+            if not self.prices.wait_loaded(symbols):
+                bot.send_message(chat_id, 'Prices are still loading, try again in a minute.')
+                return
+            text = self.price_summary() if symbol == 'ALL' else self.price_message(symbol)
 
-            # If the last message we sent was price, delete it to reduce spam
+            message = "{}\n\n@{}".format(text, update.effective_user.username)
+
+            # If the last message we sent for this symbol was price, delete it to reduce spam
+            last_message_out = self.last_message_out.get((chat_id, symbol))
             if (
-                self.last_message_out
-                and self.last_message_out.get('type') == 'price'
-                and self.last_message_out['message'].message_id
+                last_message_out
+                and last_message_out.get('type') == 'price'
+                and last_message_out['message'].message_id
             ):
                 try:
                     bot.delete_message(
                         chat_id,
-                        self.last_message_out['message'].message_id
+                        last_message_out['message'].message_id
                     )
                 except Exception as err:
                     print('Unable to delete previous price message: ', err)
                     print(traceback.format_exc())
 
-            self.last_message_out = {
+            self.last_message_out[(chat_id, symbol)] = {
                 'type': 'price',
                 'message': bot.send_message(
                     chat_id,
@@ -693,20 +755,66 @@ class TelegramMonitorBot:
                 # nbd if we cannot delete it
                 pass
 
+    def price_message(self, symbol):
+        """ Markdown price summary for symbol, rendered once per quote """
+        pdata = self.prices.get(symbol)
+        cached = self.price_messages.get(symbol)
+        if cached is not None and cached[0] is pdata:
+            return cached[1]
+
+        message = """
+*{}* ({})
+*USD Price*: {} ({}%)
+*BTC Price*: {} ({}%)
+*Market Cap*: {}
+*Volume(24h)*: {}""".format(
+            CMC_SYMBOL_TO_NAME.get(symbol, symbol),
+            symbol,
+            monetary_format(pdata.price, decimals=5),
+            pdata.percent_change,
+            btc_format(pdata.btc_price),
+            pdata.btc_percent_change,
+            monetary_format(pdata.market_cap),
+            monetary_format(pdata.volume),
+        )
+        self.price_messages[symbol] = (pdata, message)
+        return message
+
+    def price_summary(self):
+        """ One line per symbol, rendered once per set of quotes """
+        tokens = tuple(self.prices.get(symbol) for symbol in sorted(self.prices.tokens))
+        cached = self.price_messages.get('ALL')
+        if cached is not None and cached[0] == tokens:
+            return cached[1]
+
+        message = "\n".join(
+            "*{}*: {} ({}%)".format(
+                pdata.symbol,
+                monetary_format(pdata.price, decimals=5),
+                pdata.percent_change)
+            for pdata in tokens)
+        self.price_messages['ALL'] = (tokens, message)
+        return message
+
     def error(self, bot, update, error):
         """ Log Errors caused by Updates. """
         print("Update '{}' caused error '{}'".format(update, error),
             file=sys.stderr)
 
 
-    def start(self):
-        """ Start the bot. """
+    def report_startup_time(self):
+        """ Log the cold start time and warn when it exceeds the budget """
+        elapsed = time.time() - STARTED
+        budget = float(os.environ.get('STARTUP_BUDGET_SECONDS', 5))
+        print("Started in {:.2f}s (budget {:.2f}s)".format(elapsed, budget))
+        if elapsed > budget:
+            print("⚠️ Startup exceeded its budget of {:.2f}s".format(budget), file=sys.stderr)
 
-        # Create the EventHandler and pass it your bot's token.
-        updater = Updater(os.environ["TELEGRAM_BOT_TOKEN"])
+    def add_handlers(self, dp):
+        """ Register the bot's handlers with a dispatcher """
 
-        # Get the dispatcher to register handlers
-        dp = updater.dispatcher
+        # Runs first, and stops all other handlers for rejected updates
+        dp.add_handler(TypeHandler(telegram.Update, self.prefilter), group=-1)
 
         # on different commands - answer in Telegram
 
@@ -732,10 +840,200 @@ class TelegramMonitorBot:
             lambda bot, update, error : self.error(bot, update, error)
         )
 
+    def start_services(self, updater, maintenance=True):
+        """ Start the background workers. Returns the metrics exporters. """
+        dp = updater.dispatcher
+
+        # Queue depths and cache sizes, read whenever metrics are collected
+        metrics.REGISTRY.gauge(
+            'bot_dispatcher_queue_depth',
+            'Updates waiting for the dispatcher (polling only)',
+            dp.update_queue.qsize)
+        metrics.REGISTRY.gauge(
+            'bot_enrichment_queue_depth', 'Messages waiting to be enriched',
+            lambda: self.enrichment.depth)
+        metrics.REGISTRY.gauge(
+            'bot_outbox_depth', 'Telegram API calls waiting to be sent',
+            lambda: self.outbox.depth)
+        metrics.REGISTRY.gauge(
+            'bot_writer_pending_rows', 'Rows waiting to be written',
+            lambda: self.writer.pending)
+        metrics.REGISTRY.gauge(
+            'bot_known_users_cache_size', 'User IDs in the known user cache',
+            lambda: len(self.known_users))
+        metrics.REGISTRY.gauge(
+            'bot_content_cache_size', 'Message texts in the content cache',
+            lambda: len(self.content_cache))
+        metrics.REGISTRY.gauge(
+            'bot_flood_tracked_users', 'Users whose message rate is being tracked',
+            lambda: len(self.floods))
+
+        # Cache effectiveness and database pool contention
+        metrics.REGISTRY.counter_func(
+            'bot_known_users_cache_hits_total', 'Known user cache hits',
+            lambda: self.known_users.hits)
+        metrics.REGISTRY.counter_func(
+            'bot_known_users_cache_misses_total', 'Known user cache misses',
+            lambda: self.known_users.misses)
+        metrics.REGISTRY.counter_func(
+            'bot_content_cache_hits_total', 'Content cache hits by field',
+            lambda: dict(self.content_cache.hits), labels=('field',))
+        metrics.REGISTRY.counter_func(
+            'bot_content_cache_misses_total', 'Content cache misses by field',
+            lambda: dict(self.content_cache.misses), labels=('field',))
+        admin_cache = self.get_admin_ids.cache
+        metrics.REGISTRY.counter_func(
+            'bot_admin_cache_hits_total', 'Admin ID cache hits',
+            lambda: admin_cache.hits)
+        metrics.REGISTRY.counter_func(
+            'bot_admin_cache_misses_total', 'Admin ID cache misses',
+            lambda: admin_cache.misses)
+        metrics.REGISTRY.counter_func(
+            'bot_admin_cache_evictions_total', 'Admin ID cache evictions',
+            lambda: admin_cache.evictions)
+        for key, help in (
+                ('checked_out', 'Database connections in use'),
+                ('overflow', 'Database connections open above the pool size'),
+                ('max_wait', 'Longest wait for a free connection in seconds')):
+            metrics.REGISTRY.gauge(
+                'bot_db_pool_{}'.format(key), help, lambda key=key: pool_stats()[key])
+        for key, name, help in (
+                ('checkouts', 'checkouts_total', 'Database connection checkouts'),
+                ('waits', 'waits_total', 'Checkouts that had to wait for a free connection'),
+                ('wait_time', 'wait_seconds_total',
+                 'Seconds spent waiting for a free connection')):
+            metrics.REGISTRY.counter_func(
+                'bot_db_pool_{}'.format(name), help, lambda key=key: pool_stats()[key])
+        exporters = metrics.start_from_env(os.environ)
+
         # Start the Bot
+        self.maintenance = maintenance
+        self.bot = updater.bot
+        self.outbox.bot = updater.bot
+        self.outbox.start()
+        self.rules.start()
+        self.admin_refresher.start()
+        if self.prices is not None:
+            self.prices.start()
+        self.enrichment.start()
+        self.writer.start()
+        return exporters
+
+    def stop_services(self, exporters):
+        """ Flush and stop the background workers """
+        print("Known user cache: {}".format(self.known_users.stats()))
+        print("Content cache: {}".format(self.content_cache.stats()))
+        print("Admin ID cache: {}".format(self.get_admin_ids.cache.stats()))
+        print("Flood detector: {}".format(self.floods.stats()))
+        print("Database pool: {}".format(pool_stats()))
+
+        self.admin_refresher.stop()
+        self.rules.stop()
+        self.raids.end_all()
+        self.outbox.stop()
+        if self.prices is not None:
+            self.prices.stop()
+
+        # Write buffered rows, then let queued enrichment finish before exiting
+        self.writer.stop()
+        self.enrichment.stop(timeout=10)
+        print("Enrichment queue depth at exit: {}".format(self.enrichment.depth))
+
+        for exporter in exporters:
+            exporter.stop()
+
+    def started(self):
+        print("Bot started. Montitoring chats: {}".format(self.monitored_chat_ids()))
+        self.report_startup_time()
+        # Updates are already being taken, so these don't delay startup
+        threading.Thread(target=self.warm_up, name='warm-up', daemon=True).start()
+
+    def warm_up(self):
+        """ Fill the known user cache and run partition maintenance """
+        try:
+            self.known_users.warm()
+        except Exception as e:
+            print("Error warming known user cache: {}".format(e))
+            print(traceback.format_exc())
+        if self.maintenance:
+            schedule_maintenance()
+
+    def start(self):
+        """ Start the bot. """
+
+        # Create the EventHandler and pass it your bot's token.
+        updater = create_updater()
+
+        # Get the dispatcher to register handlers
+        self.add_handlers(updater.dispatcher)
+
+        exporters = self.start_services(updater)
+        run_intake(updater, self.started)
+        self.stop_services(exporters)
+
+    def start_shard(self, updates, index, shards):
+        """ Run as one of `shards` worker processes, see sharding.py.
+
+        Updates arrive as dicts on the `updates` queue, until a None, and
+        are handled in order on this thread.  The next one is only taken
+        once the last is handled, so a slow shard fills its bounded queue
+        and the front process waits instead of buffering without limit.
+        """
+        updater = create_updater()
+        dp = updater.dispatcher
+        self.add_handlers(dp)
+
+        # Only the chats routed to this shard need their admins kept warm
+        self.shard = (index, shards)
+
+        exporters = self.start_services(updater, maintenance=(index == 0))
+        metrics.REGISTRY.gauge(
+            'bot_shard_queue_depth', 'Updates waiting for this shard', updates.qsize)
+        self.started()
+
+        for data in iter(updates.get, None):
+            dp.process_update(telegram.Update.de_json(data, updater.bot))
+
+        self.stop_services(exporters)
+
+
+def create_updater(workers=dispatcher_workers):
+    return Updater(
+        os.environ["TELEGRAM_BOT_TOKEN"],
+        base_url=os.environ.get('TELEGRAM_BASE_URL'),
+        workers=workers)
+
+
+def run_intake(updater, on_started, concurrency=None):
+    """ Receive updates by polling (default) or through a webhook, as set by
+    INTAKE_MODE, until SIGINT or SIGTERM """
+    intake_mode = os.environ.get('INTAKE_MODE', 'polling').lower()
+    if intake_mode == 'webhook':
+        server = WebhookServer(
+            updater.dispatcher,
+            host=os.environ.get('WEBHOOK_HOST', '0.0.0.0'),
+            port=int(os.environ.get('WEBHOOK_PORT', os.environ.get('PORT', 8443))),
+            path=os.environ.get('WEBHOOK_PATH'),
+            concurrency=concurrency or int(os.environ.get('WEBHOOK_CONCURRENCY', 8)),
+            max_body_size=int(os.environ.get('WEBHOOK_MAX_BODY_SIZE', MAX_BODY_SIZE)))
+        metrics.REGISTRY.gauge(
+            'bot_webhook_in_flight', 'Webhook updates being handled',
+            lambda: server.in_flight)
+        metrics.REGISTRY.counter_func(
+            'bot_webhook_received_total', 'Updates received by the webhook',
+            lambda: server.received)
+        if os.environ.get('WEBHOOK_URL'):
+            # Telegram posts to the public URL followed by the secret path
+            updater.bot.set_webhook(url=os.environ['WEBHOOK_URL'].rstrip('/') + server.path)
+
+        on_started()
+
+        # Runs until SIGINT or SIGTERM
+        server.run()
+    else:
         updater.start_polling()
 
-        print("Bot started. Montitoring chats: {}".format(self.chat_ids))
+        on_started()
 
         # Run the bot until you press Ctrl-C or the process receives SIGINT,
         # SIGTERM or SIGABRT. This should be used most of the time, since
@@ -744,6 +1042,12 @@ class TelegramMonitorBot:
 
 
 if __name__ == '__main__':
-    c = TelegramMonitorBot()
-
-    c.start()
+    shards = int(os.environ.get('SHARDS', 1))
+    if shards > 1:
+        # A front process routing updates to one process per shard
+        from sharding import run_sharded
+        run_sharded(shards)
+    else:
+        c = TelegramMonitorBot()
+
+        c.start()
@@ -0,0 +1,99 @@
+"""Lookalike character normalization
+
+Spammers swap Latin letters for identical looking Cyrillic or Greek ones,
+fullwidth forms or "mathematical" bold/italic letters to get past the ban
+patterns.  unidecode alone doesn't help: it transliterates Cyrillic р to
+"r" rather than to the "p" it looks like.  `normalize` first maps such
+characters to the ASCII letter they look like with precomputed
+`str.translate` tables, and only then strips accents with unidecode.
+
+Cyrillic and Greek lookalikes are only replaced in words that mix them
+with Latin letters or consist of nothing but lookalikes, so genuine
+Russian or Greek text is still transliterated normally.
+
+"""
+
+import re
+import sys
+import unicodedata
+from functools import lru_cache
+
+import unidecode
+
+# Letters that look like Latin ones but that NFKC leaves alone
+LOOKALIKES = {
+    # Cyrillic
+    'а': 'a', 'е': 'e', 'ё': 'e', 'к': 'k', 'о': 'o', 'р': 'p', 'с': 'c',
+    'у': 'y', 'х': 'x', 'ѕ': 's',
+    'і': 'i', 'ї': 'i', 'ј': 'j', 'ԁ': 'd', 'ԛ': 'q', 'ԝ': 'w', 'һ': 'h',
+    'ӏ': 'l', 'ɡ': 'g', 'ү': 'y', 'ո': 'n', 'ս': 'u',
+    'А': 'A', 'В': 'B', 'Е': 'E', 'Ё': 'E', 'К': 'K', 'М': 'M', 'Н': 'H',
+    'О': 'O', 'Р': 'P', 'С': 'C', 'Т': 'T', 'У': 'Y', 'Х': 'X', 'Ѕ': 'S',
+    'І': 'I', 'Ї': 'I', 'Ј': 'J', 'Ԁ': 'D', 'Ԛ': 'Q', 'Ԝ': 'W', 'Һ': 'H',
+    'Ӏ': 'I', 'Ү': 'Y',
+    # Greek
+    'α': 'a', 'ε': 'e', 'ι': 'i', 'κ': 'k', 'ν': 'v', 'ο': 'o', 'ρ': 'p',
+    'τ': 't', 'υ': 'u', 'χ': 'x', 'ω': 'w',
+    'Α': 'A', 'Β': 'B', 'Ε': 'E', 'Ζ': 'Z', 'Η': 'H', 'Ι': 'I', 'Κ': 'K',
+    'Μ': 'M', 'Ν': 'N', 'Ο': 'O', 'Ρ': 'P', 'Τ': 'T', 'Υ': 'Y', 'Χ': 'X',
+    # Latin letters from other blocks
+    'ı': 'i', 'ȷ': 'j', 'ℓ': 'l',
+}
+
+# Invisible characters used to split up words
+INVISIBLE = '\u00ad\u180e\u200b\u200c\u200d\u2060\ufeff'
+
+# Blocks whose compatibility decomposition is a plain ASCII letter or
+# digit: enclosed alphanumerics, fullwidth forms and mathematical letters
+COMPATIBILITY_RANGES = [
+    (0x2460, 0x24FF),
+    (0xFF10, 0xFF5A),
+    (0x1D400, 0x1D7FF),
+    (0x1F130, 0x1F189),
+]
+
+
+def build_compatibility_table():
+    table = dict((ord(ch), None) for ch in INVISIBLE)
+    for first, last in COMPATIBILITY_RANGES:
+        for cp in range(first, min(last, sys.maxunicode) + 1):
+            mapped = unicodedata.normalize('NFKC', chr(cp))
+            if len(mapped) == 1 and mapped.isascii() and mapped.isalnum():
+                table[cp] = mapped
+    return table
+
+
+COMPATIBILITY_TABLE = build_compatibility_table()
+LOOKALIKE_TABLE = dict((ord(k), v) for k, v in LOOKALIKES.items())
+
+WORD_RE = re.compile(r'[^\W\d_]+')
+
+
+def _replace_lookalikes(match):
+    word = match.group(0)
+    if word.isascii():
+        return word
+    if any(ch.isascii() for ch in word) or all(ord(ch) in LOOKALIKE_TABLE for ch in word):
+        return word.translate(LOOKALIKE_TABLE)
+    return word
+
+
+def _normalize(text):
+    if text.isascii():
+        return text
+    text = WORD_RE.sub(_replace_lookalikes, text.translate(COMPATIBILITY_TABLE))
+    return unidecode.unidecode(text)
+
+
+# Only short strings such as names and usernames are memoized.  They repeat
+# with every message a user sends, while whole message texts are cached by
+# ContentCache and would only push the names out of this one.
+MEMOIZE_MAX_LENGTH = 64
+_normalize_short = lru_cache(maxsize=10000)(_normalize)
+
+
+def normalize(text):
+    """ Replace lookalike characters, then remove accents (é->e, ñ->n, etc...) """
+    if len(text) <= MEMOIZE_MAX_LENGTH:
+        return _normalize_short(text)
+    return _normalize(text)
@@ -0,0 +1,70 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+class ContentCache(object):
+    """TTL and size bounded cache of per-message-text results.
+
+    Entries are keyed by a hash of the message text and hold any number of
+    named fields, e.g. the normalized text, the moderation verdict and the
+    translation/sentiment result, so duplicate spam skips all of that work.
+    Hits and misses are counted per field.
+    """
+
+    def __init__(self, maxsize=10000, ttl=60*60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = {}
+        self.misses = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(text):
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+    def get(self, text, field):
+        """ Return the cached value of field for text, or None """
+        key = self.key(text)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None or field not in entry[1]:
+                self.misses[field] = self.misses.get(field, 0) + 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits[field] = self.hits.get(field, 0) + 1
+            return entry[1][field]
+
+    def set(self, text, field, value):
+        key = self.key(text)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or now - entry[0] > self.ttl:
+                entry = self._entries[key] = (now, {})
+            entry[1][field] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        rates = {}
+        for field in set(self.hits) | set(self.misses):
+            hits = self.hits.get(field, 0)
+            total = hits + self.misses.get(field, 0)
+            rates[field] = float(hits) / total if total else 0.0
+        return {
+            'size': len(self),
+            'hits': dict(self.hits),
+            'misses': dict(self.misses),
+            'hit_rate': rates,
+        }
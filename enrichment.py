@@ -0,0 +1,274 @@
+import queue
+import threading
+import time
+import traceback
+
+import metrics
+from model import Message, session_scope
+
+
+class EnrichmentQueue(object):
+    """Bounded worker pool that fills in translation and sentiment columns
+    of already stored messages.
+
+    Messages are saved raw on the hot path and only their primary key and
+    text are queued here.  When the queue is full new work is dropped
+    instead of blocking the dispatcher, and failed jobs are retried a
+    limited number of times before being given up on.  Results are kept
+    in an optional ContentCache so repeated texts are only translated
+    once.  `backend` does the actual work, see RemoteEnricher and
+    LocalEnricher.
+
+    Each worker hands the backend up to `batch_size` messages at a time,
+    waiting at most `batch_wait` seconds for a batch to fill up.
+    """
+
+    def __init__(self, backend, workers=2, maxsize=1000, max_retries=2,
+                 retry_delay=1.0, cache=None, batch_size=20, batch_wait=0.5):
+        self.backend = backend
+        self.cache = cache
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.batches = 0
+        self.workers = workers
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._threads = []
+        self.dropped = 0
+        self.failed = 0
+        self.processed = 0
+
+    @property
+    def depth(self):
+        """ Number of messages waiting to be enriched """
+        return self._queue.qsize()
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(
+                target=self._run,
+                name='enrichment-{}'.format(i),
+                daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout=None):
+        """ Stop the workers once the queue has drained, waiting at most
+        `timeout` seconds in all. Workers still busy are left behind, they
+        are daemon threads. """
+        deadline = time.time() + timeout if timeout is not None else None
+
+        def remaining():
+            return max(0, deadline - time.time()) if deadline is not None else None
+
+        for _ in self._threads:
+            try:
+                self._queue.put((None, None, 0), timeout=remaining())
+            except queue.Full:
+                break
+        for t in self._threads:
+            t.join(remaining())
+        busy = sum(1 for t in self._threads if t.is_alive())
+        if busy:
+            print("{} enrichment workers still busy at exit".format(busy))
+        self._threads = []
+
+    def submit(self, key, text, attempt=0):
+        """ Queue a message, by its primary key tuple, for enrichment.
+        Returns False if it was dropped. """
+        if not self.workers:
+            # Enrichment is turned off
+            return False
+        try:
+            self._queue.put_nowait((key, text, attempt))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            print("Enrichment queue full ({}), dropping message {}".format(
+                self.depth, key))
+            return False
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                items = [item for item in batch if item[0] is not None]
+                if items:
+                    self._process(items)
+                if len(items) < len(batch):
+                    return
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _next_batch(self):
+        """ Wait for one message, then for more until the batch is full or
+        batch_wait has passed """
+        batch = [self._queue.get()]
+        deadline = time.time() + self.batch_wait
+        while len(batch) < self.batch_size and batch[-1][0] is not None:
+            remaining = deadline - time.time()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0
+                             else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _process(self, items):
+        try:
+            values = [
+                self.cache.get(text, 'enrichment') if self.cache is not None else None
+                for _, text, _ in items
+            ]
+            missing = [i for i, v in enumerate(values) if v is None]
+            if missing:
+                enriched = self.backend.enrich_batch([items[i][1] for i in missing])
+                self.batches += 1
+                for i, v in zip(missing, enriched):
+                    values[i] = v
+                    if self.cache is not None:
+                        self.cache.set(items[i][1], 'enrichment', v)
+            with metrics.timed('db_update'):
+                self._store([(key, v) for (key, _, _), v in zip(items, values)])
+            self.processed += len(items)
+        except Exception as e:
+            print("Error enriching {} messages: {}".format(len(items), e))
+            for key, text, attempt in items:
+                if attempt < self.max_retries:
+                    self.submit(key, text, attempt + 1)
+                else:
+                    self.failed += 1
+                    print("Giving up enriching message {}".format(key))
+            print(traceback.format_exc())
+            time.sleep(self.retry_delay)
+
+    def _store(self, rows):
+        with session_scope() as s:
+            columns = Message.__table__.primary_key.columns
+            for key, values in rows:
+                # The whole key, including the partition key on Postgres,
+                # so only the message's own partition is searched
+                s.query(Message).filter(
+                    *[column == value for column, value in zip(columns, key)]
+                ).update(values, synchronize_session=False)
+
+
+def result(language_code, english_message, polarity, subjectivity):
+    return {
+        'language_code': language_code,
+        'english_message': english_message,
+        'polarity': polarity,
+        'subjectivity': subjectivity,
+    }
+
+
+class StubTranslator(object):
+    """ Stand-in for googletrans.Translator in tests and benchmarks.
+
+    Treats every text as English and counts the requests it receives.  Like
+    googletrans, a list is translated one request per item.
+    """
+
+    class Translated(object):
+        def __init__(self, src, text):
+            self.src = src
+            self.text = text
+
+    def __init__(self, src='en'):
+        self.src = src
+        self.requests = 0
+
+    def translate(self, text):
+        if isinstance(text, list):
+            return [self.translate(t) for t in text]
+        self.requests += 1
+        return self.Translated(self.src, text)
+
+
+class RemoteEnricher(object):
+    """ Google Translate for language and translation, TextBlob for sentiment """
+
+    def __init__(self, translator=None, timeout=10):
+        self.translator = translator
+        # Seconds to wait for Google, so a hung request can't block a worker
+        self.timeout = timeout
+
+    def translate(self, texts):
+        """ (source language, English text) for each text.
+
+        googletrans 2.4 has no bulk request (a list is translated one item
+        at a time), so this sends one request per distinct text.
+        """
+        if self.translator is None:
+            # Imported on first use, it is slow to load
+            from googletrans import Translator
+            self.translator = Translator(timeout=self.timeout)
+        translations = {}
+        for text in texts:
+            if text not in translations:
+                with metrics.timed('translation'):
+                    translated = self.translator.translate(text)
+                translations[text] = (translated.src, translated.text)
+        return [translations[text] for text in texts]
+
+    def enrich_batch(self, texts):
+        """ Translate texts to English and run sentiment analysis on the results """
+        # Imported on first use, it is slow to load
+        from textblob import TextBlob
+
+        results = []
+        # translate to English & log the original language
+        for language_code, english_message in self.translate(texts):
+            # run basic sentiment analysis on the translated English string
+            with metrics.timed('sentiment'):
+                analysis = TextBlob(english_message)
+                sentiment = analysis.sentiment
+            results.append(result(
+                language_code, english_message,
+                sentiment.polarity, sentiment.subjectivity))
+        return results
+
+
+class LocalEnricher(object):
+    """Offline language detection and lexicon based sentiment.
+
+    Only messages detected as non-English are sent to `translator` (a
+    RemoteEnricher), and only if one is given.  Untranslated messages keep
+    an empty english_message and neutral sentiment.
+    """
+
+    def __init__(self, translator=None):
+        self.translator = translator
+
+    def enrich_batch(self, texts):
+        import langdetect_local
+        import sentiment
+
+        with metrics.timed('language_detection'):
+            languages = langdetect_local.detect_batch(texts)
+        english = [text if lang == 'en' else None for text, lang in zip(texts, languages)]
+
+        foreign = [i for i, text in enumerate(english) if text is None]
+        if foreign and self.translator is not None:
+            translated = self.translator.translate([texts[i] for i in foreign])
+            for i, (_, english_message) in zip(foreign, translated):
+                english[i] = english_message
+
+        with metrics.timed('sentiment'):
+            scores = sentiment.score_batch([text or '' for text in english])
+        return [
+            result(lang, text or '', polarity, subjectivity)
+            for lang, text, (polarity, subjectivity) in zip(languages, english, scores)
+        ]
+
+
+def enricher_from_env(environ):
+    """ Build the enrichment backend selected by ENRICH_BACKEND """
+    translator = StubTranslator() if environ.get('TRANSLATOR') == 'stub' else None
+    remote = RemoteEnricher(translator, timeout=float(environ.get('TRANSLATE_TIMEOUT', 10)))
+    if environ.get('ENRICH_BACKEND', 'remote').lower() == 'local':
+        translate = environ.get('TRANSLATE_NON_ENGLISH', 'false').lower() != 'false'
+        return LocalEnricher(translator=remote if translate else None)
+    return remote
@@ -0,0 +1,111 @@
+"""Fake Telegram server for local testing
+
+Answers Bot API calls made by the bot with canned responses and replays
+recorded updates, one JSON object per line, to the bot's webhook.
+
+Usage:
+
+    export TELEGRAM_BASE_URL="http://localhost:8081/bot"
+    export INTAKE_MODE=webhook
+    export WEBHOOK_PATH=/local-replay
+    python bot.py &
+    python fake_telegram.py updates.jsonl http://localhost:8443/local-replay
+
+"""
+
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.request import Request, urlopen
+
+FAKE_CHAT = {'id': 0, 'type': 'supergroup', 'title': 'fake'}
+FAKE_USER = {'id': 1, 'is_bot': True, 'first_name': 'fake', 'username': 'fake_bot'}
+
+
+class FakeBotAPIHandler(BaseHTTPRequestHandler):
+    """ Returns a plausible result for every Bot API method """
+
+    message_id = 0
+    calls = {}
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        method = self.path.rsplit('/', 1)[-1]
+        FakeBotAPIHandler.calls[method] = FakeBotAPIHandler.calls.get(method, 0) + 1
+        self._respond(self._result(method))
+
+    do_GET = do_POST
+
+    def _result(self, method):
+        if method == 'getMe':
+            return FAKE_USER
+        if method == 'getChatAdministrators':
+            return []
+        if method in ('sendMessage', 'editMessageText'):
+            FakeBotAPIHandler.message_id += 1
+            return {
+                'message_id': FakeBotAPIHandler.message_id,
+                'date': int(time.time()),
+                'chat': FAKE_CHAT,
+                'from': FAKE_USER,
+                'text': '',
+            }
+        return True
+
+    def _respond(self, result):
+        body = json.dumps({'ok': True, 'result': result}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_api(host='localhost', port=8081):
+    """ Start the fake Bot API in a background thread """
+    server = ThreadingHTTPServer((host, port), FakeBotAPIHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def replay(path, webhook_url, rate=None):
+    """ POST every update in a JSON lines file to the webhook """
+    sent = 0
+    start = time.time()
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            req = Request(webhook_url, data=line.encode('utf-8'),
+                          headers={'Content-Type': 'application/json'})
+            urlopen(req).read()
+            sent += 1
+            if rate:
+                time.sleep(1.0 / rate)
+    elapsed = time.time() - start
+    print("Replayed {} updates in {:.2f}s ({:.0f}/s)".format(
+        sent, elapsed, sent / elapsed if elapsed else 0))
+
+
+if __name__ == '__main__':
+    server = serve_api()
+    if len(sys.argv) >= 3:
+        replay(sys.argv[1], sys.argv[2],
+               rate=float(sys.argv[3]) if len(sys.argv) > 3 else None)
+        print("Bot API calls: {}".format(FakeBotAPIHandler.calls))
+        server.shutdown()
+    else:
+        print("Fake Bot API listening on http://localhost:8081/bot")
+        try:
+            while True:
+                time.sleep(60)
+        except KeyboardInterrupt:
+            server.shutdown()
@@ -0,0 +1,111 @@
+import threading
+import time
+from collections import OrderedDict
+
+# FloodDetector.observe results
+FLOOD_STARTED = 'started'
+FLOODING = 'flooding'
+
+
+class UserWindow(object):
+    """Messages of one user in one chat over the last `len(buckets)` seconds.
+
+    Counts are kept in one-second buckets of a bytearray ring (saturating
+    at 255), with a running total so checking the rate doesn't sum them.
+    """
+
+    __slots__ = ('buckets', 'second', 'total', 'flooding')
+
+    def __init__(self, window, second):
+        self.buckets = bytearray(window)
+        self.second = second
+        self.total = 0
+        self.flooding = False
+
+    def add(self, second):
+        """ Count a message at `second` and return the total in the window """
+        buckets = self.buckets
+        size = len(buckets)
+        if second - self.second >= size:
+            buckets[:] = bytes(size)
+            self.total = 0
+        else:
+            for s in range(self.second + 1, second + 1):
+                i = s % size
+                self.total -= buckets[i]
+                buckets[i] = 0
+        if second > self.second:
+            self.second = second
+        i = second % size
+        if buckets[i] < 255:
+            buckets[i] += 1
+            self.total += 1
+        return self.total
+
+
+class FloodDetector(object):
+    """Per user, per chat message rate limit over a sliding window.
+
+    A user is flooding a chat while they have sent more than
+    `max_messages` messages to it within `window` seconds.  Windows are
+    kept in LRU order of last activity: users idle for a whole window are
+    dropped as new messages come in, and at most `maxsize` users are
+    tracked at once, so memory stays bounded however many users post.
+    """
+
+    def __init__(self, window=10, max_messages=10, maxsize=200000):
+        self.window = window
+        self.max_messages = max_messages
+        self.maxsize = maxsize
+        self._windows = OrderedDict()
+        self._lock = threading.Lock()
+        self.floods = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._windows)
+
+    def observe(self, chat_id, user_id, now=None):
+        """ Count a message. Returns FLOOD_STARTED for the message that
+        crosses the limit, FLOODING for the ones after it, or None. """
+        if not self.max_messages:
+            return None
+        second = int(now or time.time())
+        # One int instead of a tuple of two saves memory per tracked user
+        key = (chat_id << 64) | user_id
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None:
+                window = self._windows[key] = UserWindow(self.window, second)
+            else:
+                self._windows.move_to_end(key)
+            over = window.add(second) > self.max_messages
+
+            result = None
+            if over:
+                result = FLOODING if window.flooding else FLOOD_STARTED
+                if not window.flooding:
+                    self.floods += 1
+            window.flooding = over
+
+            self._evict(second)
+        return result
+
+    def _evict(self, second):
+        """ Drop the least recently active users if idle or over maxsize.
+        Stops at the first active one, so a call costs O(evicted). """
+        windows = self._windows
+        idle_before = second - self.window
+        while windows:
+            key, oldest = next(iter(windows.items()))
+            if oldest.second > idle_before and len(windows) <= self.maxsize:
+                return
+            del windows[key]
+            self.evicted += 1
+
+    def stats(self):
+        return {
+            'tracked': len(self),
+            'floods': self.floods,
+            'evicted': self.evicted,
+        }
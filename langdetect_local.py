@@ -0,0 +1,170 @@
+"""Offline language identification
+
+Non-Latin scripts are recognised from their Unicode ranges.  Latin script
+text is scored against character trigram profiles built at import time
+from each language's most common words, which is enough to tell apart
+the languages commonly seen in our chats without any network calls.
+
+"""
+
+import math
+import re
+from collections import Counter
+from functools import lru_cache
+
+import unidecode
+
+# (first code point, last code point, language) for scripts that mostly
+# belong to a single language
+SCRIPTS = [
+    (0x0400, 0x04FF, 'ru'),
+    (0x0370, 0x03FF, 'el'),
+    (0x0590, 0x05FF, 'iw'),
+    (0x0600, 0x06FF, 'ar'),
+    (0x0900, 0x097F, 'hi'),
+    (0x0E00, 0x0E7F, 'th'),
+    (0x3040, 0x30FF, 'ja'),
+    (0xAC00, 0xD7AF, 'ko'),
+    (0x1100, 0x11FF, 'ko'),
+    (0x4E00, 0x9FFF, 'zh-cn'),
+]
+
+COMMON_WORDS = {
+    'en': 'the be to of and a in that have i it for not on with he as you do at '
+          'this but his by from they we say her she or an will my one all would '
+          'there their what so up out if about who get which go me when make can '
+          'like time no just him know take people into year your good some could '
+          'them see other than then now look only come its over think also back '
+          'after use two how our work first well way even new want because any '
+          'these give day most us is are was were has had been token price buy '
+          'sell thanks please hello guys',
+    'es': 'de la que el en y a los se del las un por con no una su para es al lo '
+          'como mas o pero sus le ha me si sin sobre este ya entre cuando todo '
+          'esta ser son dos tambien fue habia era muy anos hasta desde esta mi '
+          'porque que solo han yo hay vez puede todos asi nos ni parte tiene el '
+          'donde bien tiempo mismo ese ahora cada e vida otro despues te otros '
+          'aunque esa eso hace otra gobierno tan durante siempre dia tanto ella '
+          'tres si dijo sido gran pais segun menos hola gracias',
+    'pt': 'de a o que e do da em um para com nao uma os no se na por mais as dos '
+          'como mas ao ele das seu sua ou quando muito nos ja eu tambem so pelo '
+          'pela ate isso ela entre depois sem mesmo aos seus quem nas me esse '
+          'eles voce essa num nem suas meu minha numa pelos elas qual nos lhe '
+          'deles essas esses pelas este dele tu te voces vos lhes meus minhas '
+          'teu tua teus tuas nosso nossa obrigado ola',
+    'fr': 'de la le et les des en un du une que est pour qui dans a par plus pas '
+          'au sur ne se ce il sont aux avec son elle ou mais nous comme on ont '
+          'cette sa ses leur y fait ete etre deux aussi bien tout sans peut tous '
+          'je vous ils dont entre meme encore faire apres ans autres moins '
+          'avait avoir sous leurs fois tres donc quand lui alors bonjour merci',
+    'de': 'der die und in den von zu das mit sich des auf fur ist im dem nicht '
+          'ein eine als auch es an werden aus er hat dass sie nach wird bei '
+          'einer um am sind noch wie einem uber einen so zum war haben nur oder '
+          'aber vor zur bis mehr durch man sein wurde sei ich du wir ihr gibt '
+          'kann schon wenn hallo danke',
+    'it': 'di e il la che in a per un del non si le una dei con da sono al alla '
+          'lo ha i gli della come anche piu ma nel delle se questo tra ci o mi '
+          'essere sua loro suo stato fatto quando dopo molto cosi tutto ancora '
+          'senza ne ciao grazie',
+    'nl': 'de van het een en in is dat op te zijn met voor niet aan er die door '
+          'ook als om maar bij nog dan wordt uit ze naar kan was wel al tot '
+          'heeft zo hij meer worden over geen we ik je jij bedankt hallo',
+    'tr': 'bir ve bu da de icin ile ne o cok daha gibi ben sen ama var olan '
+          'kadar sonra her en mi ki degil olarak onun ise diye ya hem merhaba '
+          'tesekkurler nasil neden',
+    'id': 'yang dan di ini itu dengan untuk tidak dari dalam akan pada juga '
+          'saya ke karena ada mereka kita bisa sudah atau kami apa tersebut '
+          'harus lebih oleh telah hanya seperti terima kasih halo',
+    'vi': 'cua va cac co la duoc trong cho khong mot nhung nguoi nay da voi '
+          'den tu khi nam thi de ra ban toi chung ta minh xin chao cam on',
+}
+
+WORD_RE = re.compile(r'[^\W\d_]+', re.UNICODE)
+
+
+def trigrams(word):
+    padded = ' {} '.format(word)
+    return [padded[i:i + 3] for i in range(len(padded) - 2)]
+
+
+def build_profile(words):
+    """ Log frequencies of the trigrams in a list of words """
+    counts = Counter(t for w in words for t in trigrams(w))
+    total = float(sum(counts.values()))
+    return dict((t, math.log(c / total)) for t, c in counts.items())
+
+
+PROFILES = dict(
+    (lang, (set(words.split()), build_profile(words.split())))
+    for lang, words in COMMON_WORDS.items())
+
+# Score given to trigrams a language's profile has never seen
+UNSEEN = math.log(1e-5)
+
+
+def script_language(text):
+    """ Language implied by the dominant non-Latin script, or None """
+    counts = Counter()
+    letters = 0
+    for ch in text:
+        if not ch.isalpha():
+            continue
+        letters += 1
+        cp = ord(ch)
+        if cp < 0x0250:
+            continue
+        for first, last, lang in SCRIPTS:
+            if first <= cp <= last:
+                counts[lang] += 1
+                break
+    if not counts:
+        return None
+    lang, n = counts.most_common(1)[0]
+    # Kana mixed with Han characters is Japanese
+    if lang == 'zh-cn' and counts.get('ja'):
+        lang = 'ja'
+    return lang if n * 2 >= letters else None
+
+
+@lru_cache(maxsize=4096)
+def word_scores(word):
+    """ (is a common word, summed trigram log frequency) per language.
+    Chat messages reuse few words, so these are cached across texts. """
+    return tuple(
+        (word in common, sum(profile.get(t, UNSEEN) for t in trigrams(word)))
+        for common, profile in PROFILES.values())
+
+
+def detect(text, default='en'):
+    """ Best guess of the language code (googletrans style) of text """
+    lang = script_language(text)
+    if lang is not None:
+        return lang
+
+    # Profiles are unaccented, like the text the ban patterns see
+    words = [w.lower() for w in WORD_RE.findall(unidecode.unidecode(text))]
+    if not words:
+        return default
+
+    per_word = [word_scores(w) for w in words]
+
+    best, best_score = default, None
+    for i, lang in enumerate(PROFILES):
+        hits = sum(1 for entry in per_word if entry[i][0])
+        if not hits:
+            continue
+        # Whole common words count much more than matching trigrams
+        score = hits * 5.0
+        score += sum(entry[i][1] for entry in per_word) / 10.0
+        if best_score is None or score > best_score:
+            best, best_score = lang, score
+    # Still `default` if no language's common words appear at all
+    return best
+
+
+def detect_batch(texts, default='en'):
+    """ detect() for each of texts, detecting repeated texts only once """
+    languages = {}
+    for text in texts:
+        if text not in languages:
+            languages[text] = detect(text, default)
+    return [languages[text] for text in texts]
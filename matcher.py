@@ -0,0 +1,71 @@
+import re
+
+DEFAULT_FLAGS = re.IGNORECASE | re.VERBOSE
+
+
+class RuleMatcher(object):
+    """Matches text against several classes of patterns in a single scan.
+
+    `rules` is a list of `(name, pattern)` pairs in priority order.  All
+    patterns are compiled into one regex with a named group per class, so
+    a string is scanned once and `match` reports the highest priority
+    class that matched anywhere in it.  Patterns that cannot be combined
+    fall back to one regex per class: those with capturing groups of their
+    own, whose backreferences would point at the wrong group once combined,
+    and those the combined regex fails to compile with.
+    """
+
+    def __init__(self, rules, flags=DEFAULT_FLAGS):
+        self.rules = [(name, pattern) for name, pattern in rules if pattern]
+        self.names = [name for name, _ in self.rules]
+        self._priority = dict((name, i) for i, name in enumerate(self.names))
+        self.combined = None
+        self.separate = None
+
+        if not self.rules:
+            return
+
+        separate = [(name, re.compile(pattern, flags)) for name, pattern in self.rules]
+        if any(regex.groups for _, regex in separate):
+            # Group numbers shift when patterns are combined, so e.g. \1
+            # in the second class would refer to the first class's group
+            self.separate = separate
+            return
+
+        # Patterns may end in a VERBOSE comment, hence the newline before
+        # each closing paren
+        combined = '|'.join(
+            '(?P<{}>{}\n)'.format(name, pattern) for name, pattern in self.rules)
+        try:
+            self.combined = re.compile(combined, flags)
+        except re.error as e:
+            print("Unable to combine patterns ({}), matching them one by one".format(e))
+            self.separate = separate
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    def match(self, text):
+        """ Return the name of the highest priority class matching text, or None """
+        if self.combined is not None:
+            # Alternatives are tried in priority order at each position, so
+            # resuming just after a lower priority match cannot skip over a
+            # higher priority one that overlaps it
+            best = None
+            search = self.combined.search
+            m = search(text)
+            while m is not None:
+                name = m.lastgroup
+                if best is None or self._priority[name] < self._priority[best]:
+                    best = name
+                    if self._priority[best] == 0:
+                        break
+                m = search(text, m.start() + 1)
+            return best
+
+        if self.separate is not None:
+            for name, regex in self.separate:
+                if regex.search(text):
+                    return name
+
+        return None
@@ -0,0 +1,360 @@
+"""Counters, gauges and latency histograms for the bot's processing stages
+
+Metrics live in a process wide `REGISTRY`.  Stages are timed with
+
+    with metrics.timed('regex'):
+        ...
+
+which records the duration in the `bot_stage_seconds` histogram and
+counts exceptions in `bot_stage_errors_total`.  `start_from_env` serves
+everything in the Prometheus text format on METRICS_PORT and/or prints a
+JSON snapshot every METRICS_LOG_INTERVAL seconds.
+
+"""
+
+import bisect
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+# Upper bounds in seconds, from sub-millisecond regex checks to slow API calls
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in pairs))
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def header(self):
+        return [
+            '# HELP {} {}'.format(self.name, self.help),
+            '# TYPE {} {}'.format(self.name, self.kind),
+        ]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def render(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return self.header() + [
+            '{}{} {}'.format(self.name, _format_labels(self.labels, key), value)
+            for key, value in items]
+
+    def snapshot(self):
+        with self._lock:
+            return dict(('/'.join(map(str, k)) or 'value', v) for k, v in self._values.items())
+
+
+class Gauge(Metric):
+    """ Value read from `fn` whenever the metrics are collected.  With
+    `labels`, fn returns a dict of values by label value (or tuple of them). """
+    kind = 'gauge'
+
+    def __init__(self, name, help, fn, labels=()):
+        super(Gauge, self).__init__(name, help, labels)
+        self.fn = fn
+
+    def value(self):
+        try:
+            return self.fn()
+        except Exception:
+            return {} if self.labels else float('nan')
+
+    def _items(self):
+        values = self.value()
+        if not isinstance(values, dict):
+            return []
+        return sorted(
+            (key if isinstance(key, tuple) else (key,), value)
+            for key, value in values.items())
+
+    def render(self):
+        if not self.labels:
+            return self.header() + ['{} {}'.format(self.name, self.value())]
+        return self.header() + [
+            '{}{} {}'.format(self.name, _format_labels(self.labels, key), value)
+            for key, value in self._items()]
+
+    def snapshot(self):
+        if not self.labels:
+            return self.value()
+        return dict(('/'.join(map(str, k)), v) for k, v in self._items())
+
+
+class CounterFunc(Gauge):
+    """ Counter whose total is read from `fn`, for objects that already
+    count something themselves, e.g. cache hits.  Like a Gauge, but typed
+    as a counter so rate() and resets work on it. """
+    kind = 'counter'
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # [per bucket counts + overflow, count, sum]
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+            entry[0][i] += 1
+            entry[1] += 1
+            entry[2] += value
+
+    def count(self, **labels):
+        entry = self._values.get(self._key(labels))
+        return entry[1] if entry else 0
+
+    def quantile(self, q, **labels):
+        """ Estimate of the q-quantile, interpolated within its bucket """
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+            if not entry or not entry[1]:
+                return None
+            counts = list(entry[0])
+            total = entry[1]
+        rank = q * total
+        seen = 0
+        for i, n in enumerate(counts):
+            if n and seen + n >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                if i == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[i] - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+    def render(self):
+        with self._lock:
+            items = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self._values.items())
+        lines = self.header()
+        for key, (counts, count, total) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + ('+Inf',), counts):
+                cumulative += n
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, _format_labels(self.labels, key, [('le', bound)]), cumulative))
+            labels = _format_labels(self.labels, key)
+            lines.append('{}_count{} {}'.format(self.name, labels, count))
+            lines.append('{}_sum{} {}'.format(self.name, labels, total))
+        return lines
+
+    def snapshot(self):
+        with self._lock:
+            keys = list(self._values)
+        result = {}
+        for key in keys:
+            labels = dict(zip(self.labels, key))
+            entry = self._values[key]
+            result['/'.join(map(str, key)) or 'value'] = {
+                'count': entry[1],
+                'sum': round(entry[2], 6),
+                'p50': self.quantile(0.5, **labels),
+                'p99': self.quantile(0.99, **labels),
+            }
+        return result
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _add(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None and type(existing) is type(metric):
+                if isinstance(metric, Gauge):
+                    # Registering a gauge or counter_func again points it
+                    # at the new source
+                    existing.fn = metric.fn
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name, help, fn, labels=()):
+        return self._add(Gauge(name, help, fn, labels))
+
+    def counter_func(self, name, help, fn, labels=()):
+        return self._add(CounterFunc(name, help, fn, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        """ All metrics in the Prometheus text exposition format """
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return dict((m.name, m.snapshot()) for m in metrics)
+
+    def reset(self):
+        """ Zero all counters and histograms, e.g. between benchmark runs """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            with metric._lock:
+                metric._values.clear()
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    'bot_stage_seconds', 'Time spent in each processing stage', labels=('stage',))
+STAGE_ERRORS = REGISTRY.counter(
+    'bot_stage_errors_total', 'Exceptions raised in each processing stage', labels=('stage',))
+UPDATES = REGISTRY.counter(
+    'bot_updates_total', 'Updates seen by the logger, by outcome', labels=('outcome',))
+
+
+@contextmanager
+def timed(stage):
+    """ Record the duration (and any exception) of the enclosed block """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MetricsServer(object):
+    """ Serves the registry on http://host:port/metrics from a background thread """
+
+    def __init__(self, port, host='127.0.0.1', registry=REGISTRY):
+        self.port = port
+        self.host = host
+        self.registry = registry
+        self._server = None
+
+    def start(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = _ThreadingHTTPServer((self.host, self.port), Handler)
+        threading.Thread(
+            target=self._server.serve_forever, name='metrics-http', daemon=True).start()
+        print("Serving metrics on http://{}:{}/metrics".format(self.host, self.port))
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+class JsonReporter(object):
+    """ Prints a one line JSON snapshot of the registry every `interval` seconds """
+
+    def __init__(self, interval, registry=REGISTRY):
+        self.interval = interval
+        self.registry = registry
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='metrics-json', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.report()
+
+    def report(self):
+        print(json.dumps({
+            'event': 'metrics',
+            'time': round(time.time(), 3),
+            'metrics': self.registry.snapshot(),
+        }, sort_keys=True))
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.report()
+
+
+def start_from_env(environ):
+    """ Start the exporters configured by METRICS_PORT and METRICS_LOG_INTERVAL.
+    Returns the started exporters, each with a stop() method. """
+    exporters = []
+    if environ.get('METRICS_PORT'):
+        exporters.append(MetricsServer(
+            int(environ['METRICS_PORT']),
+            host=environ.get('METRICS_HOST', '127.0.0.1')))
+    if environ.get('METRICS_LOG_INTERVAL'):
+        exporters.append(JsonReporter(float(environ['METRICS_LOG_INTERVAL'])))
+    for exporter in exporters:
+        exporter.start()
+    return exporters
@@ -0,0 +1,136 @@
+"""Schema maintenance for telegram_messages
+
+telegram_messages is partitioned by month on `time`.  Usage:
+
+    python migrations.py partition   # convert an existing unpartitioned table
+    python migrations.py maintain    # create upcoming partitions, apply retention
+
+`maintain` is meant to run daily, e.g. from Heroku Scheduler.  Partitions
+older than MESSAGE_RETENTION_MONTHS are detached from telegram_messages
+and kept as standalone archive tables, or dropped if MESSAGE_ARCHIVE is
+set to `drop`.
+
+"""
+
+import os
+import re
+import sys
+import threading
+import traceback
+from datetime import date
+
+from sqlalchemy import text
+
+import model
+from model import Message, create_message_partitions, month_start
+
+LEGACY_TABLE = '{}_legacy'.format(Message.__tablename__)
+PARTITION_RE = re.compile(r'^{}_y(\d{{4}})m(\d{{2}})$'.format(Message.__tablename__))
+
+
+def is_partitioned(conn):
+    return conn.execute(text(
+        'SELECT 1 FROM pg_partitioned_table p '
+        'JOIN pg_class c ON c.oid = p.partrelid '
+        'WHERE c.relname = :name'), name=Message.__tablename__).first() is not None
+
+
+def partitions(conn):
+    """ Names of the partitions attached to telegram_messages """
+    rows = conn.execute(text(
+        'SELECT c.relname FROM pg_inherits i '
+        'JOIN pg_class c ON c.oid = i.inhrelid '
+        'JOIN pg_class p ON p.oid = i.inhparent '
+        'WHERE p.relname = :name'), name=Message.__tablename__)
+    return [row[0] for row in rows]
+
+
+def partition_existing_table():
+    """ Move an unpartitioned telegram_messages into a partitioned one.
+
+    The old table is renamed to telegram_messages_legacy and kept, so it
+    can be dropped by hand once the copy has been checked.
+    """
+    table = Message.__tablename__
+    with model.engine.begin() as conn:
+        if is_partitioned(conn):
+            print('{} is already partitioned'.format(table))
+            return
+
+        conn.execute(text('ALTER TABLE {0} RENAME TO {1}'.format(table, LEGACY_TABLE)))
+        conn.execute(text('ALTER TABLE {1} RENAME CONSTRAINT {0}_pkey TO {1}_pkey'.format(
+            table, LEGACY_TABLE)))
+        conn.execute(text('ALTER SEQUENCE {0}_id_seq RENAME TO {1}_id_seq'.format(
+            table, LEGACY_TABLE)))
+
+        first = conn.execute(text('SELECT min(time) FROM {}'.format(LEGACY_TABLE))).scalar()
+        Message.__table__.create(conn)
+        create_message_partitions(conn, first=first)
+
+        columns = ', '.join(c.name for c in Message.__table__.columns if c.name != 'time')
+        conn.execute(text(
+            'INSERT INTO {0} ({1}, time) '
+            'SELECT {1}, COALESCE(time, :first) FROM {2}'.format(table, columns, LEGACY_TABLE)),
+            first=first or date.today())
+        conn.execute(text(
+            "SELECT setval('{0}_id_seq', (SELECT COALESCE(max(id), 0) + 1 FROM {0}), false)".format(
+                table)))
+
+    print('Partitioned {}. The old table is kept as {}'.format(table, LEGACY_TABLE))
+
+
+def apply_retention(conn, months, drop=False):
+    """ Detach (and optionally drop) partitions older than `months` months """
+    cutoff = month_start(date.today(), -months)
+    for name in partitions(conn):
+        m = PARTITION_RE.match(name)
+        if not m or date(int(m.group(1)), int(m.group(2)), 1) >= cutoff:
+            continue
+        conn.execute(text('ALTER TABLE {} DETACH PARTITION {}'.format(
+            Message.__tablename__, name)))
+        if drop:
+            conn.execute(text('DROP TABLE {}'.format(name)))
+            print('Dropped partition {}'.format(name))
+        else:
+            print('Detached partition {} for archival'.format(name))
+
+
+def maintain():
+    """ Create upcoming partitions and apply the retention policy """
+    with model.engine.begin() as conn:
+        if not is_partitioned(conn):
+            print('{} is not partitioned, run: python migrations.py partition'.format(
+                Message.__tablename__))
+            return
+        create_message_partitions(conn)
+        months = os.environ.get('MESSAGE_RETENTION_MONTHS')
+        if months:
+            apply_retention(
+                conn, int(months),
+                drop=os.environ.get('MESSAGE_ARCHIVE', '').lower() == 'drop')
+
+
+def schedule_maintenance(interval=24*60*60):
+    """ Run maintain() now and then every `interval` seconds in the background """
+    def run():
+        try:
+            maintain()
+        except Exception as e:
+            print('Error maintaining partitions: {}'.format(e))
+            print(traceback.format_exc())
+        timer = threading.Timer(interval, run)
+        timer.daemon = True
+        timer.start()
+    run()
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    model.init_engine(pool_size=1)
+    if command == 'partition':
+        partition_existing_table()
+    elif command == 'maintain':
+        maintain()
+    else:
+        print(__doc__)
+        sys.exit(1)
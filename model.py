@@ -1,11 +1,20 @@
-from sqlalchemy import Column, DateTime, BigInteger, String, Integer, Numeric, ForeignKey, func
+from sqlalchemy import Column, DateTime, BigInteger, String, Integer, Numeric, ForeignKey, Index, func
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.engine.url import make_url
 import os
+import time
+import threading
+from datetime import date
+from contextlib import contextmanager
 
 # Localhost url: postgresql://localhost/postgres
 postgres_url = os.environ["TELEGRAM_BOT_POSTGRES_URL"]
 
+# Production runs on Postgres. SQLite is only used as a local stand-in by
+# the benchmarks, without partitioning.
+is_postgres = make_url(postgres_url).get_backend_name() == 'postgresql'
+
 
 '''
 This model has been referenced from: https://www.pythoncentral.io/sqlalchemy-orm-examples/
@@ -23,8 +32,15 @@ class User(Base):
 
 
 class Message(Base):
+    """ Partitioned by month on `time`, see migrations.py """
     __tablename__ = 'telegram_messages'
-    id = Column(Integer, primary_key=True)
+    __table_args__ = (
+        Index('ix_telegram_messages_chat_id_time', 'chat_id', 'time'),
+        Index('ix_telegram_messages_user_id_time', 'user_id', 'time'),
+        {'postgresql_partition_by': 'RANGE (time)'},
+    )
+    # The partition key has to be part of the primary key
+    id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey('telegram_users.id'), nullable=False)
     message = Column(String)
     language_code = Column(String)
@@ -32,7 +48,7 @@ class Message(Base):
     chat_id = Column(BigInteger)
     polarity = Column(Numeric)
     subjectivity = Column(Numeric)
-    time = Column(DateTime, default=func.now())
+    time = Column(DateTime, primary_key=is_postgres, default=func.now())
 
 class MessageHide(Base):
     __tablename__ = 'telegram_message_hides'
@@ -50,12 +66,163 @@ class UserBan(Base):
     time = Column(DateTime, default=func.now())
 
 
-from sqlalchemy import create_engine
-engine = create_engine(postgres_url)
+class RaidSummary(Base):
+    __tablename__ = 'telegram_raid_summaries'
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(BigInteger)
+    started = Column(DateTime)
+    ended = Column(DateTime)
+    messages = Column(Integer)
+    new_users = Column(Integer)
+    hidden = Column(Integer)
+    banned = Column(Integer)
+
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.pool import QueuePool
+
+
+class PoolMetrics(object):
+    """ Counts checkouts, and how long threads waited for a pooled connection """
+
+    def __init__(self):
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds, waited):
+        with self._lock:
+            self.checkouts += 1
+            if waited:
+                self.waits += 1
+                self.wait_time += seconds
+                self.max_wait = max(self.max_wait, seconds)
+
+
+pool_metrics = PoolMetrics()
+
+
+class TimedQueuePool(QueuePool):
+    """ QueuePool that records checkout wait times in pool_metrics """
+
+    def _do_get(self):
+        # With no idle connection and no overflow left, the checkout waits
+        waited = self.checkedin() == 0 and self.overflow() >= self._max_overflow
+        start = time.time()
+        try:
+            return super(TimedQueuePool, self)._do_get()
+        finally:
+            pool_metrics.record(time.time() - start, waited)
+
+
+if is_postgres:
+    connect_args = {
+        'options': '-c statement_timeout={}'.format(
+            int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 5000))),
+    }
+else:
+    # The pool hands SQLite connections from thread to thread
+    connect_args = {'check_same_thread': False}
 
 from sqlalchemy.orm import sessionmaker
 session = sessionmaker()
-session.configure(bind=engine)
-Base.metadata.create_all(engine)
 
-print ("Created database model")
+# Created by init_engine, once the number of connections needed is known
+engine = None
+
+
+def init_engine(pool_size=5):
+    """ Create the engine, keeping up to `pool_size` connections open """
+    global engine
+    if engine is not None:
+        engine.dispose()
+    engine = create_engine(
+        postgres_url,
+        poolclass=TimedQueuePool,
+        pool_size=pool_size,
+        max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', 2)),
+        pool_timeout=int(os.environ.get('DB_POOL_TIMEOUT', 10)),
+        pool_recycle=int(os.environ.get('DB_POOL_RECYCLE', 30*60)),
+        pool_pre_ping=True,
+        connect_args=connect_args,
+    )
+    session.configure(bind=engine)
+    return engine
+
+
+@contextmanager
+def session_scope():
+    """ Unit of work in a session of its own: commit on success, roll back
+    on error, then close """
+    s = session()
+    try:
+        yield s
+        s.commit()
+    except Exception:
+        s.rollback()
+        raise
+    finally:
+        s.close()
+
+
+def month_start(d, offset=0):
+    """ First day of the month `offset` months after d """
+    months = d.year * 12 + d.month - 1 + offset
+    return date(months // 12, months % 12 + 1, 1)
+
+
+def partition_name(start):
+    return '{}_y{:04d}m{:02d}'.format(Message.__tablename__, start.year, start.month)
+
+
+def create_message_partitions(conn, first=None, months_ahead=3):
+    """ Create monthly telegram_messages partitions from `first` through
+    `months_ahead` months from now, skipping those that exist """
+    today = date.today()
+    start = month_start(first or today)
+    last = month_start(today, months_ahead)
+    while start <= last:
+        conn.execute(text(
+            'CREATE TABLE IF NOT EXISTS {} PARTITION OF {} '
+            'FOR VALUES FROM (\'{}\') TO (\'{}\')'.format(
+                partition_name(start), Message.__tablename__,
+                start.isoformat(), month_start(start, 1).isoformat())))
+        start = month_start(start, 1)
+
+
+# A partitioned table accepts no rows until it has partitions
+if is_postgres:
+    event.listen(
+        Message.__table__, 'after_create',
+        lambda target, conn, **kw: create_message_partitions(conn))
+
+
+def insert_ignore(table, index_elements, **values):
+    """ INSERT of one row that does nothing if its key already exists """
+    if is_postgres:
+        return postgresql.insert(table).values(**values).on_conflict_do_nothing(
+            index_elements=index_elements)
+    return table.insert().values(**values).prefix_with('OR IGNORE', dialect='sqlite')
+
+
+def pool_stats():
+    return {
+        'size': engine.pool.size(),
+        'checked_out': engine.pool.checkedout(),
+        'overflow': engine.pool.overflow(),
+        'checkouts': pool_metrics.checkouts,
+        'waits': pool_metrics.waits,
+        'wait_time': pool_metrics.wait_time,
+        'avg_wait': pool_metrics.wait_time / pool_metrics.waits if pool_metrics.waits else 0.0,
+        'max_wait': pool_metrics.max_wait,
+    }
+
+
+if __name__ == '__main__':
+    # Schema creation is an explicit step, run before the bot starts
+    Base.metadata.create_all(init_engine())
+
+    print ("Created database model")
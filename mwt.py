@@ -1,38 +1,126 @@
+import functools
+import threading
 import time
+from collections import OrderedDict
+
+
+class _InFlight(object):
+    """ A call being computed that other callers with the same key wait on """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
 
 class MWT(object):
-    """Memorize With Timeout"""
-    _caches = {}
-    _timeouts = {}
+    """Memorize With Timeout
 
-    def __init__(self,timeout=2):
+    Thread-safe decorator caching results for `timeout` seconds.  At most
+    `maxsize` results are kept, least recently used first out.  Concurrent
+    misses for the same key only call the wrapped function once; the other
+    callers wait for its result.  `key` builds the cache key from the call
+    arguments, which lets methods leave out `self` or other arguments that
+    don't affect the result.
+    """
+
+    def __init__(self, timeout=2, maxsize=1024, key=None):
         self.timeout = timeout
+        self.maxsize = maxsize
+        self.key = key or self._default_key
+        self.cache = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _default_key(*args, **kwargs):
+        return (args, tuple(sorted(kwargs.items())))
 
     def collect(self):
         """Clear cache of results which have timed out"""
-        for func in self._caches:
-            cache = {}
-            for key in self._caches[func]:
-                if (time.time() - self._caches[func][key][1]) < self._timeouts[func]:
-                    cache[key] = self._caches[func][key]
-            self._caches[func] = cache
+        now = time.time()
+        with self._lock:
+            expired = [k for k, v in self.cache.items() if now - v[1] >= self.timeout]
+            for k in expired:
+                del self.cache[k]
+
+    def clear(self):
+        with self._lock:
+            self.cache.clear()
+
+    def get(self, key):
+        """ Return the unexpired value for a key, or None """
+        with self._lock:
+            v = self.cache.get(key)
+            if v is not None and (time.time() - v[1]) <= self.timeout:
+                return v[0]
+            return None
+
+    def set(self, key, value):
+        """ Store a fresh value for a key, e.g. from an out of band update """
+        with self._lock:
+            self._store(key, value)
+
+    def invalidate(self, key):
+        with self._lock:
+            self.cache.pop(key, None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self.cache),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': float(self.hits) / total if total else 0.0,
+        }
+
+    def _store(self, key, value):
+        self.cache[key] = (value, time.time())
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+            self.evictions += 1
 
     def __call__(self, f):
-        self.cache = self._caches[f] = {}
-        self._timeouts[f] = self.timeout
 
+        @functools.wraps(f)
         def func(*args, **kwargs):
-            kw = sorted(kwargs.items())
-            key = (args, tuple(kw))
+            key = self.key(*args, **kwargs)
+
+            with self._lock:
+                v = self.cache.get(key)
+                if v is not None and (time.time() - v[1]) <= self.timeout:
+                    self.cache.move_to_end(key)
+                    self.hits += 1
+                    return v[0]
+                self.misses += 1
+                call = self._in_flight.get(key)
+                owner = call is None
+                if owner:
+                    call = self._in_flight[key] = _InFlight()
+
+            if not owner:
+                call.done.wait()
+                if call.error is not None:
+                    raise call.error
+                return call.value
+
             try:
-                v = self.cache[key]
-                # print("cache")
-                if (time.time() - v[1]) > self.timeout:
-                    raise KeyError
-            except KeyError:
-                # print("new")
-                v = self.cache[key] = f(*args,**kwargs),time.time()
-            return v[0]
-        func.func_name = f.__name__
+                call.value = f(*args, **kwargs)
+                with self._lock:
+                    self._store(key, call.value)
+                return call.value
+            except Exception as e:
+                call.error = e
+                raise
+            finally:
+                with self._lock:
+                    del self._in_flight[key]
+                call.done.set()
 
+        func.cache = self
         return func
@@ -0,0 +1,240 @@
+import heapq
+import itertools
+import threading
+import time
+import traceback
+
+from telegram.error import RetryAfter, TimedOut, NetworkError
+
+import metrics
+
+# Action priorities, lowest first
+DELETE = 0
+BAN = 1
+REPLY = 2
+NOTIFY = 3
+
+# Telegram rejects messages longer than this
+MAX_MESSAGE_LENGTH = 4096
+
+
+class TokenBucket(object):
+    """ Allows `rate` actions per second with bursts of up to `capacity` """
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.stamp = time.time()
+
+    def take(self, now):
+        """ Take a token. Returns 0, or the seconds to wait if none is left. """
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class Action(object):
+    def __init__(self, priority, chat_id, fn, args, kwargs):
+        self.priority = priority
+        self.chat_id = chat_id
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.attempts = 0
+
+
+class ActionQueue(object):
+    """Rate limited queue of outbound Telegram API calls.
+
+    Moderation handlers submit deletes, bans, replies and notifications
+    here instead of calling the API themselves.  Workers send them in
+    priority order (deletes, then bans, replies and notifications).
+    Telegram's per chat and global limits apply to the messages a bot
+    sends, so replies and notifications respect a global and a per-chat
+    token bucket, while deletes and bans only take from a separate, higher
+    `moderation_rate` bucket so a raid can be cleared quickly.
+    Notifications are merged into one digest message per
+    `digest_interval` seconds.  Calls
+    that hit Telegram's flood limit are retried after the `retry_after`
+    the server asks for, and failed calls up to `max_attempts` times in all.
+    """
+
+    def __init__(self, bot=None, workers=4, global_rate=30, chat_rate=1,
+                 chat_burst=20, moderation_rate=200, digest_interval=10,
+                 max_attempts=3):
+        self.bot = bot
+        self.workers = workers
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.moderation_rate = moderation_rate
+        self.digest_interval = digest_interval
+        self.max_attempts = max_attempts
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._moderation_bucket = TokenBucket(moderation_rate, moderation_rate)
+        self._chat_buckets = {}
+        self._ready = []
+        self._delayed = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._digest = {}
+        self._threads = []
+        self._stopped = False
+        self.sent = 0
+        self.failed = 0
+        self.rate_limited = 0
+
+    @property
+    def depth(self):
+        """ Number of actions waiting to be sent """
+        return len(self._ready) + len(self._delayed)
+
+    def start(self):
+        self._stopped = False
+        for i in range(self.workers):
+            t = threading.Thread(
+                target=self._run, name='outbox-{}'.format(i), daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout=10):
+        """ Send pending digests and whatever can be sent within timeout """
+        with self._cond:
+            for chat_id in list(self._digest):
+                self._push_ready(Action(NOTIFY, chat_id, self._send_digest, (chat_id,), {}))
+        deadline = time.time() + timeout
+        while self.depth and time.time() < deadline:
+            time.sleep(0.1)
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def submit(self, priority, chat_id, fn, *args, **kwargs):
+        with self._cond:
+            self._push_ready(Action(priority, chat_id, fn, args, kwargs))
+
+    def delete(self, chat_id, message_id):
+        self.submit(DELETE, chat_id, self._bot_call, 'delete_message', chat_id, message_id)
+
+    def kick(self, chat_id, user_id):
+        self.submit(BAN, chat_id, self._bot_call, 'kick_chat_member', chat_id, user_id)
+
+    def restrict(self, chat_id, user_id, until_date):
+        """ Stop user_id from sending messages to chat_id until until_date """
+        self.submit(
+            BAN, chat_id, self._bot_call, 'restrict_chat_member', chat_id, user_id,
+            until_date=until_date, can_send_messages=False)
+
+    def send(self, chat_id, text, priority=REPLY, **kwargs):
+        self.submit(priority, chat_id, self._bot_call, 'send_message', chat_id, text, **kwargs)
+
+    def notify(self, chat_id, text):
+        """ Add a line to the next digest message sent to chat_id """
+        with self._cond:
+            lines = self._digest.get(chat_id)
+            if lines is None:
+                lines = self._digest[chat_id] = []
+                self._push_delayed(
+                    Action(NOTIFY, chat_id, self._send_digest, (chat_id,), {}),
+                    time.time() + self.digest_interval)
+            lines.append(text)
+
+    def _bot_call(self, method, *args, **kwargs):
+        with metrics.timed('telegram_api'):
+            return getattr(self.bot, method)(*args, **kwargs)
+
+    def _send_digest(self, chat_id):
+        with self._cond:
+            lines = self._digest.pop(chat_id, [])
+        # Split into as few messages as Telegram allows
+        chunk = ''
+        for line in lines:
+            if chunk and len(chunk) + len(line) + 1 > MAX_MESSAGE_LENGTH:
+                self.send(chat_id, chunk, priority=NOTIFY)
+                chunk = ''
+            chunk = '{}\n{}'.format(chunk, line) if chunk else line[:MAX_MESSAGE_LENGTH]
+        if chunk:
+            self.send(chat_id, chunk, priority=NOTIFY)
+
+    def _push_ready(self, action):
+        heapq.heappush(self._ready, (action.priority, next(self._seq), action))
+        self._cond.notify()
+
+    def _push_delayed(self, action, when):
+        heapq.heappush(self._delayed, (when, next(self._seq), action))
+        self._cond.notify()
+
+    def _next(self):
+        """ Wait for the next action that may be sent now """
+        with self._cond:
+            while not self._stopped:
+                now = time.time()
+                while self._delayed and self._delayed[0][0] <= now:
+                    _, _, action = heapq.heappop(self._delayed)
+                    self._push_ready(action)
+
+                if self._ready and self._ready[0][2].priority < REPLY:
+                    # Deletes and bans don't count as sent messages
+                    wait = self._moderation_bucket.take(now)
+                    if wait:
+                        self._cond.wait(wait)
+                        continue
+                    return heapq.heappop(self._ready)[2]
+
+                if self._ready:
+                    wait = self._global_bucket.take(now)
+                    if wait:
+                        self._cond.wait(wait)
+                        continue
+                    _, _, action = heapq.heappop(self._ready)
+                    bucket = self._chat_buckets.get(action.chat_id)
+                    if bucket is None:
+                        bucket = self._chat_buckets[action.chat_id] = TokenBucket(
+                            self.chat_rate, self.chat_burst)
+                    wait = bucket.take(now)
+                    if wait:
+                        # Give the global token back and let other chats go first
+                        self._global_bucket.tokens += 1
+                        self._push_delayed(action, now + wait)
+                        continue
+                    return action
+
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                self._cond.wait(timeout)
+            return None
+
+    def _run(self):
+        while True:
+            action = self._next()
+            if action is None:
+                return
+            action.attempts += 1
+            try:
+                action.fn(*action.args, **action.kwargs)
+                self.sent += 1
+            except RetryAfter as e:
+                self.rate_limited += 1
+                if action.attempts < self.max_attempts:
+                    with self._cond:
+                        self._push_delayed(action, time.time() + e.retry_after)
+                else:
+                    self.failed += 1
+                    print("Giving up on Telegram API call, still rate limited: {}".format(e))
+            except (TimedOut, NetworkError) as e:
+                if action.attempts < self.max_attempts:
+                    with self._cond:
+                        self._push_delayed(action, time.time() + action.attempts)
+                else:
+                    self.failed += 1
+                    print("Giving up on Telegram API call: {}".format(e))
+            except Exception as e:
+                self.failed += 1
+                print("Error in Telegram API call: {}".format(e))
+                print(traceback.format_exc())
@@ -0,0 +1,258 @@
+import copy
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+# Price data cache duration
+CACHE_DURATION = timedelta(minutes=15)
+
+# CMC IDs can be retrived at:
+# https://pro-api.coinmarketcap.com/v1/cryptocurrency/map?symbol=[SYMBOL]
+CMC_SYMBOL_TO_ID = {
+    'OGN': 5117,
+    'USDT': 825,
+    'USDC': 3408,
+    'DAI': 4943,
+}
+CMC_SYMBOL_TO_NAME = {
+    'OGN': 'Origin Token',
+    'USDT': 'Tether',
+    'USDC': 'USD Coin',
+    'DAI': 'Dai',
+}
+CMC_API_KEY = os.environ.get('CMC_API_KEY')
+CMC_QUOTE_URL = 'https://pro-api.coinmarketcap.com/v1/cryptocurrency/quotes/latest'
+# Seconds to wait for CMC, so a hung request can't stall refreshes forever
+CMC_TIMEOUT = 10
+# Seconds before retrying after a failed refresh, doubling up to the max
+RETRY_MIN = 30
+RETRY_MAX = 15 * 60
+
+
+def cmc_get_data(jso, cmc_id, pair_symbol='USD'):
+    """ Pull relevant data from a response object """
+    if not jso:
+        return None
+
+    data = jso.get('data', {})
+    specific_data = data.get(str(cmc_id), {})
+    quote = specific_data.get('quote', {})
+    symbol_data = quote.get(pair_symbol, {})
+    return {
+        'price': symbol_data.get('price'),
+        'volume': symbol_data.get('volume_24h'),
+        'percent_change': symbol_data.get('percent_change_24h'),
+        'market_cap': symbol_data.get('market_cap'),
+    }
+
+
+class TokenData:
+    def __init__(self, symbol, price=None, stamp=None):
+        self.symbol = symbol
+        self.price = price
+        self.btc_price = 0
+        self._percent_change = 0
+        self.btc_percent_change = 0
+        self.volume = 0
+        self.market_cap = 0
+        if price is not None:
+            self.stamp = stamp or datetime.now()
+        else:
+            self.stamp = None
+
+    @property
+    def stale(self):
+        return self.stamp is None or self.stamp < datetime.now() - CACHE_DURATION
+
+    @property
+    def percent_change(self):
+        pc = str(self._percent_change)
+        if pc and not pc.startswith('-'):
+            pc = '+{}'.format(pc)
+        return pc
+
+    def update_usd(self, data):
+        self.price = data.get('price')
+        self._percent_change = data.get('percent_change')
+        self.volume = data.get('volume')
+        self.market_cap = data.get('market_cap')
+        self.stamp = datetime.now()
+
+    def update_btc(self, data):
+        self.btc_price = data.get('price')
+        self.btc_percent_change = data.get('percent_change')
+
+
+class PriceService(object):
+    """Keeps quotes for every symbol in CMC_SYMBOL_TO_ID in memory.
+
+    All symbols are fetched with a single batched CMC request over a
+    pooled HTTP session, asking for USD and BTC quotes at once.  If the
+    API plan doesn't allow several `convert` values, the USD and BTC
+    quotes are fetched in parallel instead.  A background thread refreshes
+    the quotes every CACHE_DURATION so `/price` answers from memory.
+
+    Stale quotes are still served while a refresh runs, and concurrent
+    refresh requests share a single call to CMC.  Nothing waits on CMC for
+    longer than `timeout` seconds.  After a failed refresh no new one starts
+    for an exponentially growing delay, or as long as CMC's Retry-After
+    asks, so reads of stale quotes don't hammer CMC while it is failing.
+    """
+
+    def __init__(self, symbol_to_id=CMC_SYMBOL_TO_ID, api_key=CMC_API_KEY,
+                 interval=CACHE_DURATION, timeout=CMC_TIMEOUT):
+        self.symbol_to_id = dict(symbol_to_id)
+        self.api_key = api_key
+        self.interval = interval
+        self.timeout = timeout
+        self.tokens = dict(
+            (symbol, TokenData(symbol)) for symbol in self.symbol_to_id)
+        self.multi_convert = True
+        # Imported here so the bot starts faster when prices are unused
+        import requests
+        self._session = requests.Session()
+        self._session.headers.update({
+            'X-CMC_PRO_API_KEY': api_key,
+            'Accept': 'application/json',
+        })
+        self._executor = ThreadPoolExecutor(
+            max_workers=2, thread_name_prefix='prices')
+        self._stopped = threading.Event()
+        self._thread = None
+        self._refresh_lock = threading.Lock()
+        self._refreshing = None
+        # Returned instead of starting a refresh while backing off
+        self._idle = threading.Event()
+        self._idle.set()
+        self._retry_at = 0
+        self._retry_delay = 0
+        self._retry_after = None
+        self.failures = 0
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='price-refresher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def get(self, symbol):
+        """ Return the TokenData for symbol without waiting on CMC.
+
+        A stale or never loaded quote is returned right away and refreshed
+        in the background.
+        """
+        token = self.tokens[symbol]
+        if token.stale:
+            self.request_refresh()
+        return token
+
+    def wait_loaded(self, symbols, timeout=2):
+        """ Wait once, up to `timeout` seconds, for a refresh if any of
+        symbols was never loaded. Returns whether all of them are loaded. """
+        if any(self.tokens[symbol].stamp is None for symbol in symbols):
+            self.request_refresh().wait(timeout)
+        return all(self.tokens[symbol].stamp is not None for symbol in symbols)
+
+    def request_refresh(self):
+        """ Start a refresh unless one is in flight or the last one failed
+        recently. Returns an Event set when it's done. """
+        with self._refresh_lock:
+            if self._refreshing is not None:
+                return self._refreshing
+            if time.time() < self._retry_at:
+                return self._idle
+            done = self._refreshing = threading.Event()
+        threading.Thread(
+            target=self._refresh_and_notify, args=(done,),
+            name='price-refresh', daemon=True).start()
+        return done
+
+    def _refresh_and_notify(self, done):
+        ok = False
+        try:
+            ok = self.refresh()
+        finally:
+            with self._refresh_lock:
+                if ok:
+                    self._retry_at = self._retry_delay = 0
+                else:
+                    self.failures += 1
+                    self._retry_delay = min(
+                        RETRY_MAX, max(RETRY_MIN, self._retry_delay * 2))
+                    delay = max(self._retry_delay, self._retry_after or 0)
+                    self._retry_at = time.time() + delay
+                    print('Price refresh failed, next attempt in {:.0f}s'.format(delay))
+                self._retry_after = None
+                self._refreshing = None
+            done.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self.request_refresh().wait()
+            # Retry sooner than the next regular refresh after a failure
+            wait = self.interval.total_seconds()
+            if self._retry_at:
+                wait = min(wait, max(1, self._retry_at - time.time()))
+            self._stopped.wait(wait)
+
+    def _fetch(self, convert):
+        """ Get quote data for all known symbols """
+        ids = ','.join(str(i) for i in self.symbol_to_id.values())
+        r = self._session.get(
+            CMC_QUOTE_URL, params={'id': ids, 'convert': convert}, timeout=self.timeout)
+        if r.status_code == 400 and ',' in convert:
+            # Not every plan accepts several convert values
+            print('Multiple convert values rejected, fetching quotes separately')
+            self.multi_convert = False
+            return None
+        if r.status_code != 200:
+            print('Failed to fetch {} price data for ids: {} ({})'.format(
+                convert, ids, r.status_code))
+            try:
+                self._retry_after = float(r.headers.get('Retry-After'))
+            except (TypeError, ValueError):
+                pass
+            return None
+        try:
+            return r.json()
+        except Exception:
+            print('Error parsing JSON')
+            return None
+
+    def refresh(self):
+        """ Fetch USD and BTC quotes for every symbol. Returns whether
+        USD quotes were received. """
+        try:
+            usd_jso = btc_jso = None
+            if self.multi_convert:
+                usd_jso = btc_jso = self._fetch('USD,BTC')
+            if not self.multi_convert:
+                usd = self._executor.submit(self._fetch, 'USD')
+                btc = self._executor.submit(self._fetch, 'BTC')
+                usd_jso, btc_jso = usd.result(), btc.result()
+        except Exception as err:
+            print('Error fetching data: ', str(err))
+            print(traceback.format_exc())
+            return False
+
+        for symbol, cmc_id in self.symbol_to_id.items():
+            # Build a new TokenData so readers never see a half updated one
+            old = self.tokens[symbol]
+            token = copy.copy(old)
+            usd_data = cmc_get_data(usd_jso, cmc_id)
+            if usd_data is not None and usd_data.get('price') is not None:
+                token.update_usd(usd_data)
+            btc_data = cmc_get_data(btc_jso, cmc_id, 'BTC')
+            if btc_data is not None and btc_data.get('price') is not None:
+                token.update_btc(btc_data)
+            self.tokens[symbol] = token
+        return usd_jso is not None
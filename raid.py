@@ -0,0 +1,143 @@
+import threading
+import time
+from datetime import datetime
+
+
+class WindowCounter(object):
+    """Event count over the last `window` seconds, kept in one-second buckets"""
+
+    __slots__ = ('buckets', 'second')
+
+    def __init__(self, window):
+        self.buckets = [0] * window
+        self.second = 0
+
+    def add(self, now, n=1):
+        """ Count n events at time now and return the total in the window """
+        self._advance(int(now))
+        self.buckets[self.second % len(self.buckets)] += n
+        return sum(self.buckets)
+
+    def total(self, now):
+        self._advance(int(now))
+        return sum(self.buckets)
+
+    def _advance(self, second):
+        size = len(self.buckets)
+        if second - self.second >= size:
+            for i in range(size):
+                self.buckets[i] = 0
+        else:
+            for s in range(self.second + 1, second + 1):
+                self.buckets[s % size] = 0
+        if second > self.second:
+            self.second = second
+
+
+class Raid(object):
+    def __init__(self, chat_id, started):
+        self.chat_id = chat_id
+        self.started = started
+        self.last_seen = started
+        self.messages = 0
+        self.new_users = 0
+        self.hidden = 0
+        self.banned = 0
+
+    def summary(self):
+        return {
+            'chat_id': self.chat_id,
+            'started': datetime.fromtimestamp(self.started),
+            'ended': datetime.fromtimestamp(self.last_seen),
+            'messages': self.messages,
+            'new_users': self.new_users,
+            'hidden': self.hidden,
+            'banned': self.banned,
+        }
+
+
+class RaidDetector(object):
+    """Per chat detector of message and new user floods.
+
+    A chat enters raid mode when more than `max_messages` messages or
+    `max_new_users` new users arrive within `window` seconds, and leaves it
+    `cooldown` seconds after the rates drop back below the thresholds.
+    Counts for the duration of a raid are handed to `on_end` as a summary.
+    """
+
+    def __init__(self, window=10, max_messages=100, max_new_users=20,
+                 cooldown=120, on_end=None):
+        self.window = window
+        self.max_messages = max_messages
+        self.max_new_users = max_new_users
+        self.cooldown = cooldown
+        self.on_end = on_end
+        self._messages = {}
+        self._new_users = {}
+        self._raids = {}
+        self._lock = threading.Lock()
+
+    def active(self, chat_id):
+        return chat_id in self._raids
+
+    def observe(self, chat_id, new_users=0, now=None):
+        """ Count a message in chat_id. Returns the Raid if the chat is in raid mode. """
+        now = now or time.time()
+        ended = []
+        with self._lock:
+            messages = self._messages.get(chat_id)
+            if messages is None:
+                messages = self._messages[chat_id] = WindowCounter(self.window)
+                self._new_users[chat_id] = WindowCounter(self.window)
+            tripped = (
+                messages.add(now) > self.max_messages
+                or self._new_users[chat_id].add(now, new_users) > self.max_new_users)
+
+            raid = self._raids.get(chat_id)
+            if tripped:
+                if raid is None:
+                    raid = self._raids[chat_id] = Raid(chat_id, now)
+                    print("🚨 Raid detected in chat {}".format(chat_id))
+                raid.last_seen = now
+            if raid is not None:
+                raid.messages += 1
+                raid.new_users += new_users
+
+            ended = self._collect(now)
+
+        for r in ended:
+            self._end(r)
+        return self._raids.get(chat_id)
+
+    def record(self, chat_id, hidden=0, banned=0):
+        """ Count fast path actions taken during a raid """
+        with self._lock:
+            raid = self._raids.get(chat_id)
+            if raid is not None:
+                raid.hidden += hidden
+                raid.banned += banned
+
+    def collect(self, now=None):
+        """ End raids whose cooldown has passed """
+        with self._lock:
+            ended = self._collect(now or time.time())
+        for r in ended:
+            self._end(r)
+
+    def end_all(self):
+        with self._lock:
+            ended = list(self._raids.values())
+            self._raids.clear()
+        for r in ended:
+            self._end(r)
+
+    def _collect(self, now):
+        ended = [r for r in self._raids.values() if now - r.last_seen > self.cooldown]
+        for r in ended:
+            del self._raids[r.chat_id]
+        return ended
+
+    def _end(self, raid):
+        print("Raid in chat {} ended: {}".format(raid.chat_id, raid.summary()))
+        if self.on_end is not None:
+            self.on_end(raid.summary())
@@ -0,0 +1,262 @@
+"""Monitored chats and per chat moderation rules
+
+The monitored chats default to CHAT_IDS, and the rules to the
+MESSAGE_BAN_PATTERNS, MESSAGE_HIDE_PATTERNS, NAME_BAN_PATTERNS,
+ALLOWED_MIME_TYPES and IGNORE_USER_IDS environment variables.  A JSON file
+named by RULES_FILE can override any of them, the rules for all chats and
+per chat:
+
+    {
+        "chat_ids": [-1001234567890, -1009876543210],
+        "default": {"ignore_user_ids": [777000]},
+        "chats": {
+            "-1001234567890": {
+                "message_hide_patterns": ["t\\.me/joinchat", "|free\\s*airdrop"],
+                "allowed_mime_types": ["video/mp4", "image/gif"]
+            }
+        }
+    }
+
+Patterns are strings or lists of lines, joined with newlines.  Each
+distinct set of patterns is compiled once into an immutable ChatRules.
+RuleStore swaps in a newly compiled RuleSet when the file changes or the
+process receives SIGHUP.  Handlers fetch a chat's ChatRules once per
+update, so an update that is in flight keeps using the rules it started
+with.
+
+Monitored chats and ignored users are frozensets, so `RuleSet.admit` can
+turn away updates from other chats or ignored users in constant time,
+however long the lists get.
+
+"""
+
+import hashlib
+import json
+import os
+import signal
+import threading
+import time
+import traceback
+
+from matcher import RuleMatcher
+
+# Keys of a rules entry and the environment variables they default to
+PATTERN_KEYS = {
+    'message_ban_patterns': 'MESSAGE_BAN_PATTERNS',
+    'message_hide_patterns': 'MESSAGE_HIDE_PATTERNS',
+    'name_ban_patterns': 'NAME_BAN_PATTERNS',
+}
+KEYS = set(PATTERN_KEYS) | {'allowed_mime_types', 'ignore_user_ids'}
+
+
+def _patterns(value):
+    if isinstance(value, (list, tuple)):
+        return '\n'.join(value)
+    return value or ''
+
+
+def _strings(value):
+    if isinstance(value, str):
+        value = value.split(',')
+    return frozenset(s.strip() for s in value if s.strip())
+
+
+def _ints(value):
+    if isinstance(value, str):
+        value = value.split(',')
+    return frozenset(int(i) for i in value if str(i).strip())
+
+
+def env_settings(environ):
+    """ Rule settings from the environment, as used before RULES_FILE existed """
+    settings = dict((key, environ.get(var, '')) for key, var in PATTERN_KEYS.items())
+    # NOTE: All gifs appear to be converted to video/mp4
+    settings['allowed_mime_types'] = environ.get('ALLOWED_MIME_TYPES', 'video/mp4')
+    settings['ignore_user_ids'] = environ.get('IGNORE_USER_IDS', '')
+    return settings
+
+
+class ChatRules(object):
+    """ Compiled, read-only rules for one or more chats """
+
+    __slots__ = ('message_matcher', 'name_matcher', 'allowed_mime_types',
+                 'ignore_user_ids', 'cache_field')
+
+    def __init__(self, message_matcher, name_matcher, allowed_mime_types,
+                 ignore_user_ids, cache_field):
+        object.__setattr__(self, 'message_matcher', message_matcher)
+        object.__setattr__(self, 'name_matcher', name_matcher)
+        object.__setattr__(self, 'allowed_mime_types', allowed_mime_types)
+        object.__setattr__(self, 'ignore_user_ids', ignore_user_ids)
+        # ContentCache field for verdicts, so chats with different
+        # patterns never share cached verdicts
+        object.__setattr__(self, 'cache_field', cache_field)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('ChatRules are read-only')
+
+
+# Reasons for RuleSet.admit to turn an update away
+UNMONITORED = 'unmonitored'
+IGNORED = 'ignored'
+
+
+class RuleSet(object):
+    """ ChatRules by chat_id, with a default for chats without their own """
+
+    def __init__(self, default, chats, chat_ids=frozenset(), source=None):
+        self.default = default
+        self.chats = chats
+        self.chat_ids = chat_ids
+        self.source = source
+
+    def for_chat(self, chat_id):
+        return self.chats.get(chat_id, self.default)
+
+    def admit(self, chat_id, user_id):
+        """ (rules, None) for an update to handle, or (None, reason) for one
+        from an unmonitored chat or an ignored user """
+        if chat_id not in self.chat_ids:
+            return None, UNMONITORED
+        rules = self.chats.get(chat_id, self.default)
+        if user_id is None or user_id in rules.ignore_user_ids:
+            return None, IGNORED
+        return rules, None
+
+
+def compile_rules(environ, config=None):
+    """ Compile the RuleSet for environment defaults overridden by config.
+
+    Identical patterns are compiled once and shared between chats.
+    """
+    base = env_settings(environ)
+    base.update((config or {}).get('default') or {})
+
+    matchers = {}
+
+    def matcher(rules):
+        key = tuple(rules)
+        if key not in matchers:
+            matchers[key] = RuleMatcher(rules)
+        return matchers[key]
+
+    def build(overrides):
+        settings = dict(base)
+        settings.update(overrides)
+        unknown = set(settings) - KEYS
+        if unknown:
+            raise ValueError('Unknown rule settings: {}'.format(', '.join(sorted(unknown))))
+        ban = _patterns(settings['message_ban_patterns'])
+        hide = _patterns(settings['message_hide_patterns'])
+        digest = hashlib.blake2b(
+            '{}\0{}'.format(ban, hide).encode('utf-8'), digest_size=4).hexdigest()
+        return ChatRules(
+            # Ban and hide patterns are checked in a single pass, ban first
+            message_matcher=matcher([('ban', ban), ('hide', hide)]),
+            name_matcher=matcher([('ban', _patterns(settings['name_ban_patterns']))]),
+            allowed_mime_types=_strings(settings['allowed_mime_types']),
+            ignore_user_ids=_ints(settings['ignore_user_ids']),
+            cache_field='moderation:{}'.format(digest))
+
+    default = build({})
+    chats = dict(
+        (int(chat_id), build(overrides or {}))
+        for chat_id, overrides in ((config or {}).get('chats') or {}).items())
+    chat_ids = _ints((config or {}).get('chat_ids', environ.get('CHAT_IDS', '')))
+    return RuleSet(default, chats, chat_ids)
+
+
+class RuleStore(object):
+    """Holds the current RuleSet and recompiles it when RULES_FILE changes.
+
+    A new RuleSet replaces the old one in a single assignment once it has
+    compiled, so readers never see a half built one.  If the file can't be
+    read or compiled the old rules stay in place.
+    """
+
+    def __init__(self, environ, path=None, interval=5):
+        self.environ = environ
+        self.path = path
+        self.interval = interval
+        self.reloads = 0
+        self._mtime = None
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.current = None
+        self.reload()
+        if self.current is None:
+            # The environment rules alone must always compile
+            self.current = self._compile(None)
+
+    def for_chat(self, chat_id):
+        return self.current.for_chat(chat_id)
+
+    def _compile(self, config):
+        start = time.perf_counter()
+        ruleset = compile_rules(self.environ, config)
+        ruleset.source = self.path if config is not None else 'environment'
+        print("Compiled rules for {} monitored chats ({} with their own) from {} in {:.1f} ms".format(
+            len(ruleset.chat_ids), len(ruleset.chats), ruleset.source,
+            (time.perf_counter() - start) * 1000))
+        return ruleset
+
+    def reload(self):
+        """ Compile the rules again and swap them in. Returns True on success. """
+        try:
+            config = None
+            if self.path:
+                self._mtime = os.path.getmtime(self.path)
+                with open(self.path) as f:
+                    config = json.load(f)
+            self.current = self._compile(config)
+            self.reloads += 1
+            return True
+        except Exception as e:
+            print("Error loading rules from {}, keeping the current rules: {}".format(
+                self.path, e))
+            print(traceback.format_exc())
+            return False
+
+    def request_reload(self):
+        """ Reload soon, from the watcher thread """
+        self._wakeup.set()
+
+    def start(self):
+        """ Watch the rules file and reload on SIGHUP """
+        if threading.current_thread() is threading.main_thread() and hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, lambda signum, frame: self.request_reload())
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='rules-watcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _changed(self):
+        if not self.path or not self.interval:
+            return False
+        try:
+            return os.path.getmtime(self.path) != self._mtime
+        except OSError:
+            return False
+
+    def _run(self):
+        while not self._stopped.is_set():
+            signalled = self._wakeup.wait(self.interval or None)
+            self._wakeup.clear()
+            if self._stopped.is_set():
+                return
+            if signalled or self._changed():
+                self.reload()
+
+
+def store_from_env(environ):
+    return RuleStore(
+        environ,
+        path=environ.get('RULES_FILE'),
+        interval=float(environ.get('RULES_RELOAD_INTERVAL', 5)))
@@ -0,0 +1,79 @@
+"""Offline lexicon based sentiment scoring
+
+Uses the English adjective lexicon that ships with TextBlob (the same one
+its default PatternAnalyzer uses), read straight from the package data so
+neither TextBlob nor NLTK has to be imported.  Polarity and subjectivity
+are the averages over the words found in the lexicon, with the polarity
+of a word flipped after a negation.
+
+"""
+
+import importlib.util
+import os
+import re
+import threading
+import xml.etree.ElementTree as ET
+
+WORD_RE = re.compile(r"[a-z][a-z'\-]*")
+NEGATIONS = frozenset(['not', 'never', "isn't", "don't", "doesn't", "can't", "won't", 'no'])
+
+_lexicon = None
+_lock = threading.Lock()
+
+
+def lexicon_path():
+    spec = importlib.util.find_spec('textblob')
+    return os.path.join(spec.submodule_search_locations[0], 'en', 'en-sentiment.xml')
+
+
+def load_lexicon(path=None):
+    """ Map each word to its average (polarity, subjectivity) across senses """
+    senses = {}
+    for word in ET.parse(path or lexicon_path()).getroot().iter('word'):
+        form = word.get('form').lower()
+        senses.setdefault(form, []).append((
+            float(word.get('polarity', 0)),
+            float(word.get('subjectivity', 0))))
+    return dict(
+        (form, (sum(p for p, _ in s) / len(s), sum(q for _, q in s) / len(s)))
+        for form, s in senses.items())
+
+
+def lexicon():
+    global _lexicon
+    if _lexicon is None:
+        with _lock:
+            if _lexicon is None:
+                _lexicon = load_lexicon()
+    return _lexicon
+
+
+def score(text):
+    """ (polarity, subjectivity) of an English text """
+    words = lexicon()
+    polarity = subjectivity = 0.0
+    found = 0
+    negate = False
+    for token in WORD_RE.findall(text.lower()):
+        if token in NEGATIONS:
+            negate = True
+            continue
+        entry = words.get(token)
+        if entry is None:
+            continue
+        found += 1
+        polarity += -0.5 * entry[0] if negate else entry[0]
+        subjectivity += entry[1]
+        negate = False
+    if not found:
+        return 0.0, 0.0
+    return polarity / found, subjectivity / found
+
+
+def score_batch(texts):
+    """ score() for each of texts, scoring repeated texts only once """
+    scores = {}
+    for text in texts:
+        if text not in scores:
+            scores[text] = score(text)
+    return [scores[text] for text in texts]
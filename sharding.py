@@ -0,0 +1,166 @@
+"""Spread monitored chats over several bot processes
+
+    SHARDS=4 python bot.py
+
+The front process receives updates (polling or webhook, as set by
+INTAKE_MODE), drops those from unmonitored chats or ignored users, and
+puts each of the others on the queue of shard `chat_id % SHARDS`.
+Every shard is a complete TelegramMonitorBot in its own process, with its
+own caches, database pool and background workers, and handles its updates
+in order on its main thread, so the updates of a chat are
+processed in the order Telegram sent them.
+
+"""
+
+import multiprocessing
+import os
+import signal
+import sys
+import time
+import traceback
+
+import metrics
+from rules import store_from_env
+
+# Updates waiting per shard before the front process blocks
+DEFAULT_QUEUE_SIZE = 1000
+
+
+def shard_for(chat_id, shards):
+    """ Index of the shard handling chat_id """
+    return chat_id % shards
+
+
+def run_shard(index, shards, updates):
+    """ Entry point of a shard process """
+    # The front process tells shards when to stop, so they can flush first
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    # Until the rules install their reload handler
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    # Telegram's global rate limits are shared by all shards, and every shard
+    # serves its metrics on its own port after the front process
+    for name, default in (('OUTBOX_GLOBAL_RATE', 30), ('OUTBOX_MODERATION_RATE', 200)):
+        os.environ[name] = str(float(os.environ.get(name, default)) / shards)
+    if os.environ.get('METRICS_PORT'):
+        os.environ['METRICS_PORT'] = str(int(os.environ['METRICS_PORT']) + 1 + index)
+
+    # Shards take their updates from the front process, one at a time,
+    # which sizes their database pool
+    os.environ['INTAKE_MODE'] = 'shard'
+
+    import bot
+    print("Starting shard {} of {}".format(index, shards))
+    bot.TelegramMonitorBot().start_shard(updates, index, shards)
+
+
+class ShardRouter(object):
+    """Starts the shard processes and hands each update to its shard.
+
+    Updates are passed as dicts over bounded multiprocessing queues.  When
+    a shard falls behind, `route` blocks, which slows down intake instead
+    of buffering without limit.
+    """
+
+    def __init__(self, shards, rules, queue_size=DEFAULT_QUEUE_SIZE):
+        self.rules = rules
+        # Shards import the bot and connect to the database themselves
+        context = multiprocessing.get_context('spawn')
+        self.queues = [context.Queue(maxsize=queue_size) for _ in range(shards)]
+        self.processes = [
+            context.Process(
+                target=run_shard, args=(i, shards, q), name='shard-{}'.format(i))
+            for i, q in enumerate(self.queues)
+        ]
+        self.routed = metrics.REGISTRY.counter(
+            'bot_shard_updates_total', 'Updates routed to each shard', labels=('shard',))
+        for i, q in enumerate(self.queues):
+            metrics.REGISTRY.gauge(
+                'bot_shard_{}_queue_depth'.format(i),
+                'Updates waiting for shard {}'.format(i),
+                q.qsize)
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+
+    def stop(self, timeout=30):
+        """ Let every shard drain its queue and shut down """
+        for q in self.queues:
+            q.put(None)
+        deadline = time.time() + timeout
+        for process in self.processes:
+            process.join(max(0, deadline - time.time()))
+            if process.is_alive():
+                print("Shard {} did not stop in time, terminating it".format(process.name))
+                process.terminate()
+
+    def signal_shards(self, signum):
+        for process in self.processes:
+            if process.is_alive():
+                os.kill(process.pid, signum)
+
+    def route(self, bot, update):
+        """ Handler callback putting update on its chat's shard queue """
+        chat = update.effective_chat
+        user = update.effective_user
+        chat_id = chat.id if chat is not None else None
+        _, rejected = self.rules.current.admit(
+            chat_id, user.id if user is not None else None)
+        if rejected:
+            # Shards would only turn it away again.  Counted like the bot's
+            # own prefilter does, so the shard label only has shard numbers
+            metrics.UPDATES.inc(outcome=rejected)
+            return
+        shard = shard_for(chat_id, len(self.queues))
+        if not self.processes[shard].is_alive():
+            print("Shard {} is not running, dropping update {}".format(
+                shard, update.update_id), file=sys.stderr)
+            return
+        self.queues[shard].put(update.to_dict())
+        self.routed.inc(shard=shard)
+
+
+def run_sharded(shards):
+    """ Run the front process with `shards` shard processes """
+    from telegram import Update
+    from telegram.ext import TypeHandler
+
+    import bot
+
+    rules = store_from_env(os.environ)
+    rules.start()
+    router = ShardRouter(
+        shards, rules,
+        queue_size=int(os.environ.get('SHARD_QUEUE_SIZE', DEFAULT_QUEUE_SIZE)))
+    router.start()
+
+    def reload(signum, frame):
+        rules.request_reload()
+        router.signal_shards(signum)
+
+    # Shards reload their rules on SIGHUP too
+    signal.signal(signal.SIGHUP, reload)
+
+    # Routing is cheap, and one thread keeps updates in the order received
+    updater = bot.create_updater(workers=1)
+    updater.dispatcher.add_handler(TypeHandler(Update, router.route))
+    updater.dispatcher.add_error_handler(
+        lambda bot, update, error: print(
+            "Error routing update {}: {}".format(update, error), file=sys.stderr))
+    exporters = metrics.start_from_env(os.environ)
+
+    try:
+        bot.run_intake(
+            updater,
+            lambda: print("Routing updates to {} shards".format(shards)),
+            concurrency=1)
+    except Exception as e:
+        print("Error in intake: {}".format(e))
+        print(traceback.format_exc())
+    finally:
+        router.stop()
+        rules.stop()
+        for exporter in exporters:
+            exporter.stop()
@@ -0,0 +1,54 @@
+import threading
+from collections import OrderedDict
+
+from model import User, session_scope
+
+
+class KnownUserCache(object):
+    """Bounded LRU set of user IDs known to exist in `telegram_users`"""
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, user_id):
+        with self._lock:
+            if user_id in self._ids:
+                self._ids.move_to_end(user_id)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, user_id):
+        with self._lock:
+            self._ids[user_id] = True
+            self._ids.move_to_end(user_id)
+            while len(self._ids) > self.maxsize:
+                self._ids.popitem(last=False)
+
+    def discard(self, user_id):
+        with self._lock:
+            self._ids.pop(user_id, None)
+
+    def warm(self):
+        """ Load up to `maxsize` known user IDs from the database """
+        with session_scope() as s:
+            for (user_id,) in s.query(User.id).limit(self.maxsize):
+                self.add(user_id)
+        print("Known user cache warmed with {} users".format(len(self)))
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / total if total else 0.0,
+        }
@@ -0,0 +1,137 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import signal
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import telegram
+
+# Telegram updates are a few KB at most
+MAX_BODY_SIZE = 1024 * 1024
+
+
+def secret_path(token):
+    """ Webhook path derived from the bot token, so only Telegram (which
+    gets it through setWebhook) knows where to post updates """
+    return '/' + hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+class WebhookServer(object):
+    """Minimal asyncio HTTP server that receives Telegram webhook updates.
+
+    Each POSTed update is decoded and handed to the dispatcher on a thread
+    pool, with at most `concurrency` updates being handled at once.  When
+    all slots are busy, requests wait for a free slot before being read
+    further, which pushes back on Telegram instead of buffering in memory.
+
+    Updates are only accepted on `path`, which defaults to a secret derived
+    from the bot token, and bodies over `max_body_size` are refused unread.
+    """
+
+    def __init__(self, dispatcher, host='0.0.0.0', port=8443, path=None,
+                 concurrency=8, max_body_size=MAX_BODY_SIZE):
+        self.dispatcher = dispatcher
+        self.bot = dispatcher.bot
+        self.host = host
+        self.port = port
+        self.path = path or secret_path(self.bot.token)
+        self.max_body_size = max_body_size
+        self.concurrency = concurrency
+        self.in_flight = 0
+        self.received = 0
+        self._executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix='webhook')
+        self._slots = None
+        self._server = None
+
+    def run(self):
+        """ Serve until SIGINT or SIGTERM """
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._server = await asyncio.start_server(
+            self._handle_connection, self.host, self.port)
+        # The path is a secret, keep it out of the logs
+        print("Webhook listening on {}:{}/{}...".format(self.host, self.port, self.path[1:5]))
+
+        async with self._server:
+            await stop.wait()
+
+        # Let handlers that are already running finish
+        self._executor.shutdown(wait=True)
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                method, path, body = request
+                if body is None:
+                    # The body was left unread, so the connection can't be reused
+                    writer.write(b'HTTP/1.1 413 Payload Too Large\r\n'
+                                 b'Content-Length: 0\r\nConnection: close\r\n\r\n')
+                    await writer.drain()
+                    break
+                status = await self._handle_request(method, path, body)
+                writer.write(
+                    'HTTP/1.1 {}\r\nContent-Length: 0\r\n\r\n'.format(status).encode())
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            print("Webhook connection error: {}".format(e))
+            print(traceback.format_exc())
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        method, path, _ = line.decode('latin-1').split(' ', 2)
+        length = 0
+        while True:
+            header = await reader.readline()
+            if header in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = header.decode('latin-1').partition(':')
+            if name.strip().lower() == 'content-length':
+                length = int(value.strip())
+        if not 0 <= length <= self.max_body_size:
+            return method, path, None
+        body = await reader.readexactly(length) if length else b''
+        return method, path, body
+
+    async def _handle_request(self, method, path, body):
+        if not hmac.compare_digest(path.encode('latin-1'), self.path.encode('latin-1')):
+            return '404 Not Found'
+        if method != 'POST':
+            return '405 Method Not Allowed'
+        try:
+            update = telegram.Update.de_json(json.loads(body.decode('utf-8')), self.bot)
+        except Exception as e:
+            print("Invalid update received by webhook: {}".format(e))
+            return '400 Bad Request'
+
+        self.received += 1
+        await self._slots.acquire()
+        self.in_flight += 1
+        future = asyncio.get_running_loop().run_in_executor(
+            self._executor, self.dispatcher.process_update, update)
+        future.add_done_callback(self._release)
+        return '200 OK'
+
+    def _release(self, future):
+        self.in_flight -= 1
+        self._slots.release()
+        if future.exception() is not None:
+            print("Error processing update: {}".format(future.exception()))
@@ -0,0 +1,152 @@
+import atexit
+import threading
+import traceback
+from collections import OrderedDict
+
+import metrics
+import model as db
+from model import Base
+
+
+class BatchWriter(object):
+    """Write-behind buffer for model rows.
+
+    Rows are grouped by table and written as multi-row INSERTs in a single
+    transaction, either when `max_rows` are waiting or every `max_delay`
+    seconds.  Whatever is still buffered is flushed on `stop()` and at
+    interpreter exit.
+    """
+
+    def __init__(self, max_rows=500, max_delay=1.0):
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._rows = []
+        self._thread = None
+        self.flushes = 0
+        self.written = 0
+        atexit.register(self.flush)
+
+    @property
+    def pending(self):
+        """ Number of rows waiting to be written """
+        return len(self._rows)
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='batch-writer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stop the background thread and write everything still buffered """
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def add(self, model, callback=None, **values):
+        """ Buffer a row for `model`.
+
+        If given, `callback` is called with the new row's primary key, a
+        tuple of its values, once the row has been written.
+        """
+        with self._lock:
+            self._rows.append((model, values, callback))
+            full = len(self._rows) >= self.max_rows
+        if full:
+            self._wakeup.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.max_delay)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print("Error flushing batch writer: {}".format(e))
+                print(traceback.format_exc())
+
+    def flush(self):
+        """ Write all buffered rows """
+        with self._flush_lock:
+            with self._lock:
+                rows, self._rows = self._rows, []
+            if not rows:
+                return
+
+            # Group by table, parents before the tables referencing them
+            batches = OrderedDict()
+            for model, values, callback in rows:
+                batches.setdefault(model, []).append((values, callback))
+            order = Base.metadata.sorted_tables
+            batches = OrderedDict(sorted(
+                batches.items(), key=lambda b: order.index(b[0].__table__)))
+
+            try:
+                with metrics.timed('db_insert'):
+                    callbacks = self._write(batches)
+            except Exception as e:
+                print("Error writing batch of {} rows, retrying one by one: {}".format(
+                    len(rows), e))
+                with metrics.timed('db_insert_each'):
+                    callbacks = self._write_each(batches)
+
+            self.flushes += 1
+            self.written += len(rows)
+
+        for callback, pk in callbacks:
+            try:
+                callback(pk)
+            except Exception as e:
+                print("Error in batch writer callback: {}".format(e))
+                print(traceback.format_exc())
+
+    def _write(self, batches):
+        callbacks = []
+        with db.engine.begin() as conn:
+            for model, items in batches.items():
+                for i in range(0, len(items), self.max_rows):
+                    chunk = items[i:i + self.max_rows]
+                    callbacks.extend(self._insert(conn, model, chunk))
+        return callbacks
+
+    def _write_each(self, batches):
+        callbacks = []
+        for model, items in batches.items():
+            for item in items:
+                try:
+                    with db.engine.begin() as conn:
+                        callbacks.extend(self._insert(conn, model, [item]))
+                except Exception as e:
+                    print("Error writing {} row: {}".format(model.__name__, e))
+                    print(traceback.format_exc())
+        return callbacks
+
+    def _insert(self, conn, model, items):
+        table = model.__table__
+        stmt = table.insert().values([values for values, _ in items])
+        if not any(callback for _, callback in items):
+            conn.execute(stmt)
+            return []
+        if conn.dialect.implicit_returning:
+            # The whole key, e.g. (id, time) for partitioned messages
+            ids = [
+                tuple(row)
+                for row in conn.execute(stmt.returning(*table.primary_key.columns))]
+        else:
+            # No RETURNING (SQLite), get the keys one row at a time
+            ids = [
+                tuple(conn.execute(table.insert().values(values)).inserted_primary_key)
+                for values, _ in items
+            ]
+        return [
+            (callback, pk)
+            for (_, callback), pk in zip(items, ids)
+            if callback is not None
+        ]